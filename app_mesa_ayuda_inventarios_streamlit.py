@@ -1,19 +1,32 @@
 
-import os, sqlite3, smtplib, ssl, random, string, hmac, hashlib as _hashlib, json, requests, io, base64
-from email.mime.text import MIMEText
-from datetime import datetime, timedelta, date
+import os, sqlite3, ssl, secrets, hmac, hashlib as _hashlib, io, base64, shutil, mmap, re, threading, logging, types
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from datetime import datetime, date, timezone
 import pandas as pd
 import streamlit as st
 import streamlit.components.v1 as components
 
+# Primera llamada de Streamlit del script; si otra ya se adelantó, se conserva el layout por defecto.
+try:
+    st.set_page_config(page_title="Mesa de Ayuda + Inventarios (Enterprise+)", layout="wide")
+except st.errors.StreamlitAPIException:
+    pass
+
 APP_DB_PATH = os.getenv("APP_DB_PATH", os.path.join(os.getcwd(), "inventarios_helpdesk.db"))
 SSO_SHARED_SECRET = os.getenv("SSO_SHARED_SECRET", "")
 SLACK_WEBHOOK_URL = os.getenv("SLACK_WEBHOOK_URL")
 TEAMS_WEBHOOK_URL = os.getenv("TEAMS_WEBHOOK_URL")
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
+log = logging.getLogger(__name__)
+SCRYPT_N = int(os.getenv("SCRYPT_N", "16384"))  # costo de contraseñas nuevas (potencia de 2)
+SCRYPT_R, SCRYPT_P = 8, 1
+PBKDF2_LEGACY_ITER = 120_000  # iteraciones de los hashes heredados "salt$hex"
 
 # --------- Estilos ---------
-st.markdown("""
+_CSS = """
 <style>
 .small-muted { color:#64748b; font-size:0.9rem; }
 .badge { display:inline-block; padding:2px 8px; border-radius:999px; background:#e2e8f0; margin-right:6px; }
@@ -22,71 +35,192 @@ st.markdown("""
 .btn-danger button { background:#dc2626 !important; color:white !important; border-radius:12px; }
 .kpi { background:#fff; border:1px solid #e5e7eb; border-radius:16px; padding:12px 16px; }
 </style>
-""", unsafe_allow_html=True)
+"""
+
+# Se emite en cada rerun: un elemento que no se vuelve a emitir desaparece de la página.
+def _inject_css():
+    st.markdown(_CSS, unsafe_allow_html=True)
 
 # --------- Seguridad ---------
-def _pbkdf2_hash(password: str, salt: str) -> str:
-    import hashlib, binascii
-    dk = hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), 120_000)
-    return binascii.hexlify(dk).decode()
+def _pbkdf2_hash(password: str, salt: str, iterations: int) -> str:
+    return _hashlib.pbkdf2_hmac("sha256", password.encode(), salt.encode(), iterations).hex()
 
+# hashlib.scrypt es OpenSSL (C). maxmem a la medida de n/r/p: el tope por defecto (32 MiB) rechaza n >= 32768.
+def _scrypt_hash(password: str, salt: str, n: int, r: int, p: int) -> str:
+    return _hashlib.scrypt(password.encode(), salt=salt.encode(), n=n, r=r, p=p, dklen=32,
+                           maxmem=128*r*(n + p + 2)).hex()
+
+# Formato: scrypt$n$r$p$salt$hex (el costo viaja con el hash y puede subirse sin invalidar usuarios)
 def hash_password(password: str) -> str:
-    salt = ''.join(random.choices(string.ascii_letters + string.digits, k=16))
-    return salt + "$" + _pbkdf2_hash(password, salt)
+    salt = secrets.token_hex(16)
+    return f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}${salt}${_scrypt_hash(password, salt, SCRYPT_N, SCRYPT_R, SCRYPT_P)}"
 
+# Acepta también los PBKDF2 heredados (salt$hex)
 def verify_password(password: str, salted_hash: str) -> bool:
     try:
+        if salted_hash.startswith("scrypt$"):
+            _, n, r, p, salt, h = salted_hash.split("$")
+            return hmac.compare_digest(_scrypt_hash(password, salt, int(n), int(r), int(p)), h)
         salt, h = salted_hash.split("$", 1)
-        return _pbkdf2_hash(password, salt) == h
+        return hmac.compare_digest(_pbkdf2_hash(password, salt, PBKDF2_LEGACY_ITER), h)
     except Exception:
         return False
 
+# Hash heredado (PBKDF2) o scrypt con parámetros distintos de los actuales: se rehace en el próximo login.
+def needs_rehash(salted_hash: str) -> bool:
+    return not salted_hash.startswith(f"scrypt${SCRYPT_N}${SCRYPT_R}${SCRYPT_P}$")
+
 def safe_filename(name: str) -> str:
     return str(name).replace("..","_").replace("/","_").replace("\\\\","_")
 
-def send_email(to_email: str, subject: str, body: str):
+SMTP_KEYS = ("smtp_host","smtp_port","smtp_user","smtp_password","smtp_from")
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")  # validación básica, con fullmatch
+
+def _smtp_config():
     # Prioriza settings persistidos; fallback a variables de entorno
-    host = get_setting("smtp_host", os.getenv("SMTP_HOST"))
-    user = get_setting("smtp_user", os.getenv("SMTP_USER"))
-    pwd  = get_setting("smtp_password", os.getenv("SMTP_PASSWORD"))
-    port = int(get_setting("smtp_port", os.getenv("SMTP_PORT") or "587"))
-    from_addr = get_setting("smtp_from", user or "")
-    if not (host and user and pwd and to_email):
-        return False
-    msg = MIMEText(body, "plain", "utf-8")
-    msg["Subject"] = subject
-    msg["From"] = from_addr or user
-    msg["To"] = to_email
-    try:
-        context = ssl.create_default_context()
-        with smtplib.SMTP(host, port) as server:
-            server.starttls(context=context)
-            server.login(user, pwd)
-            server.send_message(msg)
-        return True
+    s = get_settings_bulk(SMTP_KEYS)
+    host = s.get("smtp_host", os.getenv("SMTP_HOST"))
+    user = s.get("smtp_user", os.getenv("SMTP_USER"))
+    pwd  = s.get("smtp_password", os.getenv("SMTP_PASSWORD"))
+    port = int(s.get("smtp_port", os.getenv("SMTP_PORT") or "587"))
+    from_addr = s.get("smtp_from", user or "")
+    if not (host and user and pwd):
+        return None
+    return {"host": host, "port": port, "user": user, "pwd": pwd, "from": from_addr or user}
+
+# Sesión SMTP persistente por proceso: TLS + login una vez, NOOP antes de reutilizarla.
+# "sig" identifica la configuración con la que se abrió (contraseña solo como hash): si cambia,
+# la sesión anterior se cierra antes de reconectar. El lock la serializa entre el hilo del script y el de correo.
+@st.cache_resource(show_spinner=False)
+def _smtp_client():
+    return types.SimpleNamespace(lock=threading.Lock(), server=None, sig=None)
+
+def _smtp_sig(cfg: dict) -> tuple:
+    return (cfg["host"], cfg["port"], cfg["user"], _hashlib.sha256(cfg["pwd"].encode()).hexdigest())
+
+# smtplib/email y requests se importan donde se usan: solo los paga el proceso que envía algo.
+def _smtp_session(cfg: dict, client):
+    import smtplib
+    sig = _smtp_sig(cfg)
+    if client.server is not None:
+        try:
+            if client.sig == sig and client.server.noop()[0] == 250: return client.server
+        except (smtplib.SMTPException, OSError):
+            pass
+        _smtp_close(client)
+    server = smtplib.SMTP(cfg["host"], cfg["port"], timeout=30)
+    server.starttls(context=ssl.create_default_context())
+    server.login(cfg["user"], cfg["pwd"])
+    client.server, client.sig = server, sig
+    return server
+
+def _smtp_close(client):
+    try: client.server.quit()
     except Exception:
-        return False
+        try: client.server.close()
+        except Exception: pass
+    client.server = client.sig = None
+
+# Varios mensajes (to, subject, body) sobre la sesión compartida; el cliente se resuelve en el hilo del script.
+def _deliver_many(cfg: dict, messages: list, client) -> int:
+    import smtplib
+    from email.mime.text import MIMEText
+    sent = 0
+    with client.lock:
+        try:
+            server = _smtp_session(cfg, client)
+            for to_email, subject, body in messages:
+                msg = MIMEText(body, "plain", "utf-8")
+                msg["Subject"] = subject
+                msg["From"] = cfg["from"]
+                msg["To"] = to_email
+                try:
+                    server.send_message(msg); sent += 1
+                except smtplib.SMTPRecipientsRefused:
+                    log.warning("Destinatario rechazado: %s", to_email)
+        except Exception:
+            _smtp_close(client)
+            log.exception("No se pudo enviar correo a %s", ", ".join(m[0] for m in messages))
+    return sent
+
+# Un solo hilo: los envíos comparten una sesión serializada por el lock, más hilos solo esperarían.
+@st.cache_resource(show_spinner=False)
+def _mail_pool():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="mail")
 
-def _post_webhook(url, payload):
+# Un correo en segundo plano: devuelve el Future (resultado True/False) o None si no hay SMTP configurado.
+def send_email(to_email: str, subject: str, body: str):
+    cfg = _smtp_config()
+    if not (cfg and to_email):
+        return None
+    client = _smtp_client()
+    return _mail_pool().submit(lambda: _deliver_many(cfg, [(to_email, subject, body)], client) == 1)
+
+# Notificaciones desde la UI: la configuración se lee aquí (hilo del script) y el envío SMTP va en segundo plano.
+def send_emails_async(messages: list):
+    messages = [m for m in messages if m[0]]
+    cfg = _smtp_config() if messages else None
+    if cfg:
+        _mail_pool().submit(_deliver_many, cfg, messages, _smtp_client())
+
+# Sesión HTTP compartida: keep-alive con los webhooks en vez de un handshake TLS por aviso.
+@st.cache_resource(show_spinner=False)
+def _http_session():
+    import requests
+    session = requests.Session()
+    session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+@st.cache_resource(show_spinner=False)
+def _webhook_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="webhook")
+
+def _post_webhook(session, url, payload):
     try:
-        if not url: return
-        headers = {"Content-Type":"application/json"}
-        requests.post(url, data=json.dumps(payload), headers=headers, timeout=5)
+        session.post(url, json=payload, timeout=5)
     except Exception:
-        pass
+        log.warning("Webhook fallido: %s", url, exc_info=True)
 
+# Los avisos salen en paralelo y en segundo plano: no retrasan el rerun.
 def notify_webhooks(event_type: str, data: dict):
-    payload = {"event": event_type, "data": data, "ts": datetime.utcnow().isoformat()}
-    _post_webhook(SLACK_WEBHOOK_URL, payload)
-    _post_webhook(TEAMS_WEBHOOK_URL, payload)
-    _post_webhook(DISCORD_WEBHOOK_URL, payload)
+    urls = [u for u in (SLACK_WEBHOOK_URL, TEAMS_WEBHOOK_URL, DISCORD_WEBHOOK_URL) if u]
+    if not urls: return
+    payload = {"event": event_type, "data": data, "ts": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+    session, pool = _http_session(), _webhook_pool()
+    for url in urls:
+        pool.submit(_post_webhook, session, url, payload)
 
 # --------- DB ---------
-def get_cx():
-    cx = sqlite3.connect(APP_DB_PATH, check_same_thread=False)
+# WAL + synchronous=NORMAL: una escritura ya no implica fsync por commit y los lectores no bloquean al escritor.
+SQLITE_PRAGMAS = ("journal_mode=WAL", "synchronous=NORMAL", "temp_store=MEMORY",
+                  "cache_size=-64000", "mmap_size=268435456", "foreign_keys=ON")
+
+# Una sola conexión por proceso (autocommit); el esquema se migra al abrirla.
+# Caché de sentencias preparadas más amplio que el de fábrica (128): sitio para todos los textos SQL de la app, incluidos los dinámicos (paginado, filtros).
+SQLITE_CACHED_STATEMENTS = 256
+
+@st.cache_resource(show_spinner=False)
+def get_connection():
+    cx = sqlite3.connect(APP_DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=SQLITE_CACHED_STATEMENTS)
     cx.row_factory = sqlite3.Row
+    for p in SQLITE_PRAGMAS:
+        cx.execute(f"PRAGMA {p}")
+    ensure_schema(cx)
     return cx
 
+# Agregaciones (dashboard/reportes): conexión aparte de solo lectura; con WAL no espera a las escrituras.
+@st.cache_resource(show_spinner=False)
+def get_analytics_connection():
+    get_connection()  # crea el archivo, WAL y esquema antes de abrir en modo ro
+    cx = sqlite3.connect(Path(os.path.abspath(APP_DB_PATH)).as_uri() + "?mode=ro", uri=True, check_same_thread=False,
+                         cached_statements=SQLITE_CACHED_STATEMENTS)
+    cx.execute("PRAGMA query_only=ON")
+    return cx
+
+@st.cache_resource(show_spinner=False)
+def _write_lock():
+    return threading.RLock()
+
 INIT_SQL = """
 -- Usuarios y equipos
 CREATE TABLE IF NOT EXISTS users(
@@ -136,6 +270,7 @@ CREATE TABLE IF NOT EXISTS change_approvals(
   decided_at TEXT,
   notes TEXT
 );
+CREATE INDEX IF NOT EXISTS ix_cappr_ticket ON change_approvals(ticket_id, status);
 
 -- Matriz Urgencia × Impacto por servicio y SLA
 CREATE TABLE IF NOT EXISTS service_matrix(
@@ -174,8 +309,15 @@ CREATE TABLE IF NOT EXISTS tickets(
   created_at TEXT NOT NULL,
   updated_at TEXT NOT NULL,
   due_at TEXT,
-  response_due_at TEXT
+  response_due_at TEXT,
+  created_day TEXT
 );
+CREATE INDEX IF NOT EXISTS ix_tickets_itil_updated ON tickets(itil_type, updated_at DESC);
+CREATE INDEX IF NOT EXISTS ix_tickets_creator ON tickets(created_by, itil_type);
+-- Cubre las métricas del dashboard (estado + vencimiento) sin leer la tabla, también por agente y por creador.
+CREATE INDEX IF NOT EXISTS ix_tickets_status ON tickets(status, due_at);
+CREATE INDEX IF NOT EXISTS ix_tickets_assignee_status ON tickets(assigned_to, status, due_at);
+CREATE INDEX IF NOT EXISTS ix_tickets_creator_status ON tickets(created_by, status, due_at);
 CREATE TABLE IF NOT EXISTS ticket_status_history(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   ticket_id INTEGER NOT NULL,
@@ -183,6 +325,12 @@ CREATE TABLE IF NOT EXISTS ticket_status_history(
   changed_by INTEGER NOT NULL,
   changed_at TEXT NOT NULL
 );
+CREATE INDEX IF NOT EXISTS ix_tsh_ticket ON ticket_status_history(ticket_id, changed_at DESC);
+-- Consecutivo diario de códigos de ticket
+CREATE TABLE IF NOT EXISTS ticket_seq(
+  day TEXT PRIMARY KEY,
+  n INTEGER NOT NULL
+);
 
 -- Encuestas
 CREATE TABLE IF NOT EXISTS ticket_surveys(
@@ -223,6 +371,7 @@ CREATE TABLE IF NOT EXISTS asset_maintenances(
   performed_at TEXT NOT NULL,
   notes TEXT
 );
+CREATE INDEX IF NOT EXISTS ix_maint_asset ON asset_maintenances(asset_id, performed_at DESC);
 CREATE TABLE IF NOT EXISTS asset_assignments(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   asset_id INTEGER NOT NULL,
@@ -232,6 +381,7 @@ CREATE TABLE IF NOT EXISTS asset_assignments(
   returned_at TEXT,
   notes TEXT
 );
+CREATE INDEX IF NOT EXISTS ix_asg_asset ON asset_assignments(asset_id, assigned_at DESC);
 CREATE TABLE IF NOT EXISTS asset_policies(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   asset_id INTEGER NOT NULL,
@@ -263,6 +413,7 @@ CREATE TABLE IF NOT EXISTS ci_relations(
   child_ci_id INTEGER NOT NULL,
   relation_type TEXT
 );
+CREATE INDEX IF NOT EXISTS ix_cirel_child ON ci_relations(child_ci_id);
 CREATE TABLE IF NOT EXISTS kb_articles(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   code TEXT UNIQUE,
@@ -286,73 +437,239 @@ CREATE TABLE IF NOT EXISTS ticket_attachments(
   uploaded_by INTEGER,
   uploaded_at TEXT NOT NULL
 );
+CREATE INDEX IF NOT EXISTS ix_tatt_ticket ON ticket_attachments(ticket_id, uploaded_at DESC);
 CREATE TABLE IF NOT EXISTS asset_files(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
   asset_id INTEGER NOT NULL,
   file_name TEXT NOT NULL,
   file_path TEXT NOT NULL,
   file_type TEXT,
+  maintenance_id INTEGER,
+  contract_id INTEGER,
+  policy_id INTEGER,
   uploaded_by INTEGER,
   uploaded_at TEXT NOT NULL
 );
 """
 
-def _ensure_asset_files_extra_cols():
-    cx = get_cx(); c = cx.cursor()
-    try:
-        c.execute("PRAGMA table_info(asset_files)")
-        cols = {r[1] for r in c.fetchall()}
-    except Exception:
-        cols = set()
-    add = []
-    if "maintenance_id" not in cols: add.append(("maintenance_id","INTEGER"))
-    if "contract_id" not in cols: add.append(("contract_id","INTEGER"))
-    if "policy_id" not in cols: add.append(("policy_id","INTEGER"))
-    for name, typ in add:
-        try:
-            c.execute(f"ALTER TABLE asset_files ADD COLUMN {name} {typ}")
-        except Exception:
-            pass
-    cx.commit()
+# Columnas que INIT_SQL ya declara pero que bases creadas con versiones anteriores no tienen.
+EXTRA_COLUMNS = {
+    "asset_files": (("maintenance_id","INTEGER"), ("contract_id","INTEGER"), ("policy_id","INTEGER")),
+    "tickets": (("created_day","TEXT"),),
+}
+
+# Depende de EXTRA_COLUMNS: se ejecuta después de agregarlas.
+POST_MIGRATION_SQL = """
+-- Fechas ISO con 'T' (versiones previas usaban isoformat()) al formato de datetime('now'): las comparaciones son de texto.
+UPDATE tickets SET created_at=datetime(created_at), updated_at=datetime(updated_at), response_due_at=datetime(response_due_at), due_at=datetime(due_at)
+ WHERE created_at LIKE '%T%' OR updated_at LIKE '%T%' OR response_due_at LIKE '%T%' OR due_at LIKE '%T%';
+UPDATE change_approvals SET decided_at=datetime(decided_at) WHERE decided_at LIKE '%T%';
+UPDATE ticket_surveys SET created_at=datetime(created_at) WHERE created_at LIKE '%T%';
+UPDATE tickets SET created_day=substr(created_at,1,10) WHERE created_day IS NULL;
+CREATE INDEX IF NOT EXISTS ix_tickets_day ON tickets(created_day);
+CREATE INDEX IF NOT EXISTS ix_afiles_mt ON asset_files(asset_id, maintenance_id, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS ix_afiles_pol ON asset_files(asset_id, policy_id, uploaded_at DESC);
+CREATE INDEX IF NOT EXISTS ix_afiles_con ON asset_files(asset_id, contract_id, uploaded_at DESC);
+-- Relaciones CI repetidas (bases previas) se dejan en una antes del índice único.
+DELETE FROM ci_relations WHERE id NOT IN (SELECT MIN(id) FROM ci_relations GROUP BY parent_ci_id, child_ci_id, relation_type);
+CREATE UNIQUE INDEX IF NOT EXISTS ux_cirel ON ci_relations(parent_ci_id, child_ci_id, relation_type);
+"""
 
-def migrate_schema():
-    cx = get_cx()
-    c = cx.cursor()
-    for stmt in [s.strip() for s in INIT_SQL.split(";\n") if s.strip()]:
-        try: c.execute(stmt + ";")
-        except Exception: pass
-    cx.commit()
-    _ensure_asset_files_extra_cols()
-    return cx
+# ALTERs pendientes de EXTRA_COLUMNS (bases creadas con versiones anteriores del esquema).
+def _missing_columns_sql(cx) -> str:
+    stmts = []
+    for table, cols in EXTRA_COLUMNS.items():
+        have = {r[1] for r in cx.execute(f"PRAGMA table_info({table})").fetchall()}
+        stmts += [f"ALTER TABLE {table} ADD COLUMN {name} {typ};" for name, typ in cols if name not in have]
+    return "\n".join(stmts)
+
+# Cada bloque en una sola transacción: un COMMIT por bloque en vez de uno por sentencia.
+def _apply_script(cx, script: str, label: str):
+    if not script.strip(): return
+    try:
+        cx.executescript(f"BEGIN;\n{script}\nCOMMIT;")
+    except sqlite3.OperationalError:
+        if cx.in_transaction: cx.execute("ROLLBACK")
+        log.exception("Error aplicando %s", label)
+
+def migrate_schema(cx):
+    _apply_script(cx, INIT_SQL, "INIT_SQL")
+    _apply_script(cx, _missing_columns_sql(cx), "EXTRA_COLUMNS")
+    _apply_script(cx, POST_MIGRATION_SQL, "POST_MIGRATION_SQL")
+
+# Streamlit re-ejecuta el módulo en cada rerun: el flag vive en un recurso cacheado, no en un global.
+@st.cache_resource(show_spinner=False)
+def _schema_state():
+    return types.SimpleNamespace(lock=threading.Lock(), ready=False)
+
+def ensure_schema(cx):
+    state = _schema_state()
+    if state.ready: return
+    with state.lock:
+        if state.ready: return
+        migrate_schema(cx)
+        state.ready = True
 
 def run_query(sql, params=()):
-    cx = migrate_schema()
-    return pd.read_sql_query(sql, cx, params=params)
+    return pd.read_sql_query(sql, get_connection(), params=params)
+
+# Sentencias frecuentes: el mismo texto reaprovecha la sentencia preparada del caché de sqlite3.
+TICKET_STATUSES = ("Nuevo","Asignado","En Progreso","En Espera","Aprobación","Resuelto","Cerrado")
+TICKET_DONE = ("Resuelto","Cerrado")
+# Métricas del dashboard en una fila de ancho fijo: una pasada sobre tickets, sin GROUP BY.
+# Columnas con nombre (generales y del usuario, "mis_*") y luego un conteo por cada estado de TICKET_STATUSES.
+# Parámetros con nombre (:uid, :s0..): dashboard_params(user_id).
+_OPEN = f"status NOT IN ({','.join(repr(s) for s in TICKET_DONE)})"
+_MINE = "(assigned_to=:uid OR created_by=:uid)"
+_DASHBOARD_METRICS = {
+    "total": "COUNT(*)",
+    "abiertos": f"COUNT(CASE WHEN {_OPEN} THEN 1 END)",
+    "vencidos": f"COUNT(CASE WHEN {_OPEN} AND due_at < datetime('now') THEN 1 END)",
+    "mis_abiertos": f"COUNT(CASE WHEN {_OPEN} AND {_MINE} THEN 1 END)",
+    "mis_24h": f"COUNT(CASE WHEN {_OPEN} AND {_MINE} AND due_at >= datetime('now') AND due_at < datetime('now','+24 hours') THEN 1 END)",
+    "mis_vencidos": f"COUNT(CASE WHEN {_OPEN} AND {_MINE} AND due_at < datetime('now') THEN 1 END)",
+}
+_METRIC_COLS = len(_DASHBOARD_METRICS)  # los conteos por estado empiezan en esta columna
+SQL_DASHBOARD_METRICS = ("SELECT " + ", ".join(f"{expr} AS {name}" for name, expr in _DASHBOARD_METRICS.items()) + ", "
+                         + ", ".join(f"COUNT(CASE WHEN status=:s{i} THEN 1 END)" for i in range(len(TICKET_STATUSES))) + " FROM tickets")
+
+def dashboard_params(user_id: int) -> dict:
+    return {"uid": int(user_id), **{f"s{i}": s for i, s in enumerate(TICKET_STATUSES)}}
+SQL_INSERT_TICKET = """INSERT INTO tickets(code,title,description,category,itil_type,service_id,priority,urgency,impact,status,created_by,watchers_emails,created_at,updated_at,response_due_at,due_at,created_day)
+                        VALUES(?,?,?,?,?,?,?,?,?,?,?,?,datetime('now'),datetime('now'),datetime('now',?),datetime('now',?),strftime('%Y-%m-%d','now'))"""
+SQL_UPDATE_TICKET_STATUS = "UPDATE tickets SET status=?, updated_at=datetime('now') WHERE id=?"
+SQL_INSERT_STATUS_HISTORY = "INSERT INTO ticket_status_history(ticket_id,status,changed_by,changed_at) VALUES(?,?,?,datetime('now'))"
+SQL_INSERT_TICKET_ATTACHMENT = "INSERT INTO ticket_attachments(ticket_id,file_name,file_path,uploaded_by,uploaded_at) VALUES(?,?,?,?,datetime('now'))"
+
+# Una fila o un escalar: cursor directo, sin construir un DataFrame.
+def fetchone(sql, params=()) -> sqlite3.Row | None:
+    return get_connection().execute(sql, params).fetchone()
+
+def fetchval(sql, params=(), default=None):
+    row = fetchone(sql, params)
+    return row[0] if row else default
+
+# EXISTS se detiene en la primera coincidencia (COUNT(*) las recorre todas).
+def exists(sql, params=()) -> bool:
+    return bool(fetchval(f"SELECT EXISTS({sql})", params))
+
+# Lecturas de solo visualización: se reutilizan entre reruns hasta la próxima escritura.
+# Columnas respaldadas por Arrow en vez de object.
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_query(sql: str, params: tuple=()) -> pd.DataFrame:
+    return pd.read_sql_query(sql, get_connection(), params=params, dtype_backend="pyarrow")
+
+# params: tupla para "?" o dict para ":nombre" (p. ej. dashboard_params).
+@st.cache_data(ttl=30, show_spinner=False)
+def analytics_query(sql: str, params: tuple | dict=()) -> pd.DataFrame:
+    return pd.read_sql_query(sql, get_analytics_connection(), params=params, dtype_backend="pyarrow")
+
+# Escalares (conteos de paginación): sin DataFrame que construir ni deserializar en cada acierto.
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_scalar(sql: str, params: tuple=()):
+    return fetchval(sql, params)
+
+# Opciones de selectbox (etiqueta -> id) directo del cursor: el widget solo necesita la lista de etiquetas.
+@st.cache_data(ttl=30, show_spinner=False)
+def cached_options(sql: str, params: tuple=()) -> dict:
+    return dict(get_connection().execute(sql, params).fetchall())
+
+def _invalidate_reads():
+    cached_query.clear(); analytics_query.clear(); cached_scalar.clear(); cached_options.clear()
+
+PAGE_SIZE = 50
+MAX_GRID_ROWS = 500  # tope de filas para tablas de detalle que no se paginan
+
+# Una clave por panel, no por registro: "owner" es el registro mostrado y al cambiar vuelve a la página 1.
+def paginate(key: str, total: int, page_size: int=PAGE_SIZE, owner=None):
+    pages = max((total + page_size - 1) // page_size, 1)
+    if owner is not None and st.session_state.get(f"{key}_owner") != owner:
+        st.session_state[f"{key}_owner"] = owner; st.session_state[key] = 1
+    # El valor vive solo en session_state (sin value= en el widget): 1 al empezar, acotado si bajó el total.
+    cur = st.session_state.get(key, 1)
+    if key not in st.session_state or cur > pages: st.session_state[key] = min(cur, pages)
+    page = st.number_input("Página", min_value=1, max_value=pages, step=1, key=key) if pages > 1 else 1
+    st.caption(f"{total} registros · página {int(page)} de {pages}")
+    return page_size, (int(page) - 1) * page_size
+
+# Listados largos: solo se carga la página visible; el total sale de un COUNT(*) cacheado.
+def paged_query(key: str, sql: str, params: tuple=(), page_size: int=PAGE_SIZE, owner=None) -> pd.DataFrame:
+    total = int(cached_scalar(f"SELECT COUNT(*) FROM ({sql})", tuple(params)))
+    limit, offset = paginate(key, total, page_size, owner)
+    return cached_query(sql + " LIMIT ? OFFSET ?", tuple(params) + (limit, offset))
+
+# Catálogos de formularios y selectores: cambian poco y se leen en cada rerun.
+def q_services() -> pd.DataFrame:
+    return cached_query("SELECT id, name FROM services ORDER BY name")
+
+def q_areas() -> pd.DataFrame:
+    return cached_query("SELECT id, name FROM areas ORDER BY name")
+
+def q_service_options() -> dict:
+    return cached_options("SELECT name, id FROM services ORDER BY name")
+
+def q_team_options() -> dict:
+    return cached_options("SELECT name, id FROM teams ORDER BY name")
+
+def q_ci_items() -> pd.DataFrame:
+    return cached_query("SELECT id, name FROM ci_items ORDER BY name")
+
+def q_service_sla(service_id: int) -> pd.DataFrame:
+    return cached_query("SELECT priority, response_hours, resolve_hours FROM service_sla WHERE service_id=?", (int(service_id),))
+
+def q_agents() -> pd.DataFrame:
+    return cached_query("SELECT id, username, COALESCE(email,'') AS email FROM users WHERE role='agente' AND active=1 ORDER BY username")
+
+def q_service_matrix(service_id: int) -> pd.DataFrame:
+    return cached_query("SELECT urgency, impact, priority FROM service_matrix WHERE service_id=? ORDER BY urgency, impact", (int(service_id),))
+
+# Todas las lecturas de una vista en una sola llamada; con una única conexión compartida, repartirlas en hilos no daría paralelismo.
+def run_queries(queries: dict) -> dict:
+    return {name: cached_query(sql, tuple(params)) for name, (sql, params) in queries.items()}
 
 def run_script(sql, params=()):
-    cx = migrate_schema()
-    cx.execute(sql, params); cx.commit()
+    with _write_lock():
+        get_connection().execute(sql, params)
+    _invalidate_reads()
+
+@contextmanager
+def transaction():
+    # BEGIN IMMEDIATE toma el lock de escritura al inicio: lecturas y escrituras del bloque son atómicas.
+    cx = get_connection()
+    with _write_lock():
+        cx.execute("BEGIN IMMEDIATE")
+        try:
+            yield cx
+        except Exception:
+            cx.execute("ROLLBACK"); raise
+        cx.execute("COMMIT")
+    _invalidate_reads()
+
+# Misma sentencia para varias filas: un executemany y un solo COMMIT.
+def run_many(sql, seq_of_params):
+    with transaction() as cx:
+        cx.executemany(sql, seq_of_params)
 
 # Settings helpers
-def get_setting(key: str, default: str|None=None):
+# Lectura de settings: varias claves en una consulta (p. ej. todo el bloque SMTP); las ausentes no vienen en el dict.
+@st.cache_data(ttl=60, show_spinner=False)
+def get_settings_bulk(keys: tuple) -> dict:
     try:
-        r = run_query("SELECT value FROM settings WHERE key=?", (key,))
-        if r.empty: return default
-        return r.loc[0,"value"]
+        rows = get_connection().execute(f"SELECT key, value FROM settings WHERE key IN ({','.join('?'*len(keys))})", keys).fetchall()
+        return {k: v for k, v in rows if v is not None}
     except Exception:
-        return default
+        return {}
 
 def set_setting(key: str, value: str):
     try:
-        ex = run_query("SELECT COUNT(*) n FROM settings WHERE key=?", (key,))
-        if int(ex.loc[0,"n"])>0:
-            run_script("UPDATE settings SET value=? WHERE key=?", (value, key))
-        else:
-            run_script("INSERT INTO settings(key,value) VALUES(?,?)", (key, value))
+        run_script("INSERT INTO settings(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value", (key, value))
+        get_settings_bulk.clear()
         return True
     except Exception:
         return False
 
+# Los directorios se crean una vez por proceso (cache_resource: el módulo se re-ejecuta en cada rerun).
+@st.cache_resource(show_spinner=False)
 def get_upload_root():
     base = os.getenv("APP_UPLOAD_DIR")
     try:
@@ -369,6 +686,27 @@ def get_upload_root():
     except Exception:
         return os.getcwd()
 
+# Adjuntos con permisos 0640 (sin lectura para otros usuarios) y búfer de 1 MiB: una escritura por bloque copiado.
+def fast_open(dest: str):
+    fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_CLOEXEC", 0), 0o640)
+    return os.fdopen(fd, "wb", buffering=1 << 20)
+
+# Copia el UploadedFile por bloques de 1 MiB: sin materializar todo el archivo en un bytes.
+def _save_upload(f, dest: str):
+    f.seek(0)
+    with fast_open(dest) as out:
+        shutil.copyfileobj(f, out, 1 << 20)
+
+@st.cache_resource(show_spinner=False)
+def _io_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="upload")
+
+# Escribe varios archivos en paralelo (la E/S libera el GIL). Un mismo destino se escribe una
+# sola vez, con el último archivo, como en la versión secuencial.
+def _save_uploads(writes: list):
+    by_dest = {dest: f for f, dest in writes}
+    list(_io_pool().map(_save_upload, by_dest.values(), by_dest.keys()))
+
 # --------- SSO token ---------
 def try_token_sso():
     try:
@@ -376,88 +714,94 @@ def try_token_sso():
         user = q.get("user"); ts = q.get("ts"); sig = q.get("sig")
         if not (user and ts and sig and SSO_SHARED_SECRET): return
         check = hmac.new(SSO_SHARED_SECRET.encode(), f"{user}:{ts}".encode(), _hashlib.sha256).hexdigest()
-        if check != sig: return
-        df = run_query("SELECT * FROM users WHERE username=?", (user,))
-        if df.empty:
+        if not hmac.compare_digest(check, str(sig)): return
+        row = fetchone("SELECT * FROM users WHERE username=?", (user,))
+        if row is None:
             run_script("INSERT INTO users(username,password,role,created_at) VALUES(?,?,?,datetime('now'))",
-                       (user, hash_password("Temporal123!"), "usuario"))
-            df = run_query("SELECT * FROM users WHERE username=?", (user,))
-        st.session_state["auth_user"] = dict(df.iloc[0])
+                       (user, hash_password(secrets.token_urlsafe(32)), "usuario"))
+            row = fetchone("SELECT * FROM users WHERE username=?", (user,))
+        st.session_state["auth_user"] = session_user(row)
     except Exception:
         pass
 
 # --------- SLA & Matriz ---------
+# Se resuelven sobre la matriz/SLA cacheados del servicio: cambiar urgencia o impacto no consulta la DB.
 def matrix_priority(service_id, urgency, impact):
     if not service_id: return "Media"
-    r = run_query("SELECT priority FROM service_matrix WHERE service_id=? AND urgency=? AND impact=?", (int(service_id), urgency, impact))
-    if r.empty: return "Media"
-    return r.loc[0,"priority"]
+    m = q_service_matrix(service_id)
+    return dict(zip(zip(m["urgency"], m["impact"]), m["priority"])).get((urgency, impact), "Media")
 
 def compute_sla(service_id, priority):
     if not service_id: return 8, 24
-    r = run_query("SELECT response_hours, resolve_hours FROM service_sla WHERE service_id=? AND priority=?", (int(service_id), priority))
+    sla = q_service_sla(service_id)
+    r = sla[sla["priority"] == priority]
     if r.empty: return 8, 24
-    return int(r.loc[0,"response_hours"]), int(r.loc[0,"resolve_hours"])
+    return int(r["response_hours"].iloc[0]), int(r["resolve_hours"].iloc[0])
 
 # --------- Depreciación ---------
-def compute_depreciation(cost: float, salvage: float, life_years: int, acq_date: str, as_of=None):
-    try:
-        if as_of is None: as_of = date.today()
-        if not acq_date: return 0.0, 0.0, cost, 0
-        y,m,d = (int(x) for x in acq_date.split("-"))
-        acq = date(y,m,d)
-        months = max((as_of.year - acq.year)*12 + (as_of.month - acq.month), 0)
-        base = max(cost - salvage, 0)
-        total_months = max(life_years*12, 1)
-        per_month = base/total_months
-        acumulada = min(per_month*months, base)
-        valor_libros = max(cost - acumulada, salvage)
-        return round(per_month,2), round(acumulada,2), round(valor_libros,2), months
-    except Exception:
-        return 0.0, 0.0, cost, 0
+# Línea recta por meses completos, en columnas: una pasada para toda la página visible del listado de activos.
+def compute_depreciation_df(df: pd.DataFrame, life_col: str, as_of=None, cost_col: str="acquisition_cost",
+                            salvage_col: str="salvage_value", acq_col: str="acquisition_date") -> pd.DataFrame:
+    if as_of is None: as_of = date.today()
+    cost = pd.to_numeric(df[cost_col], errors="coerce").fillna(0).astype(float)
+    salvage = pd.to_numeric(df[salvage_col], errors="coerce").fillna(0).astype(float)
+    life = pd.to_numeric(df[life_col], errors="coerce").fillna(0).astype(float)
+    acq = pd.to_datetime(df[acq_col], format="%Y-%m-%d", errors="coerce")
+    has_date = acq.notna()
+    months = ((as_of.year - acq.dt.year)*12 + (as_of.month - acq.dt.month)).clip(lower=0).fillna(0)
+    base = (cost - salvage).clip(lower=0)
+    per_month = (base / (life*12).clip(lower=1)).where(has_date, 0.0)
+    acumulada = (per_month*months).clip(upper=base)
+    valor_libros = (cost - acumulada).clip(lower=salvage).where(has_date, cost)
+    return pd.DataFrame({"per_month": per_month.round(2), "acumulada": acumulada.round(2),
+                         "valor_libros": valor_libros.round(2), "months": months.astype(int)}, index=df.index)
 
-def compute_depr_pair(row: dict):
-    pm_f, acc_f, vl_f, m_f = compute_depreciation(float(row.get("acquisition_cost") or 0), float(row.get("salvage_value") or 0),
-                                                  int(row.get("fiscal_life_years") or 0), row.get("acquisition_date") or "")
-    pm_n, acc_n, vl_n, m_n = compute_depreciation(float(row.get("acquisition_cost") or 0), float(row.get("salvage_value") or 0),
-                                                  int(row.get("niif_life_years") or 0), row.get("acquisition_date") or "")
-    return (pm_f, acc_f, vl_f, m_f), (pm_n, acc_n, vl_n, m_n)
+def compute_depreciation(cost: float, salvage: float, life_years: int, acq_date: str, as_of=None):
+    one = pd.DataFrame({"acquisition_cost": [cost], "salvage_value": [salvage], "life": [life_years], "acquisition_date": [acq_date or None]})
+    pm, acc, vl, months = compute_depreciation_df(one, "life", as_of).iloc[0]
+    return float(pm), float(acc), float(vl), int(months)
 
 # --------- Sesión ---------
+# En sesión solo lo necesario (nunca el hash de contraseña).
+def session_user(row) -> dict:
+    return {k: row[k] for k in ("id","username","role","email")}
+
 def get_current_user():
     return st.session_state.get("auth_user")
 
 def login(username, password):
-    df = run_query("SELECT * FROM users WHERE username=? AND active=1", (username,))
-    if df.empty: return False
-    row = df.iloc[0]
+    row = fetchone("SELECT * FROM users WHERE username=? AND active=1", (username,))
+    if row is None: return False
     if verify_password(password, row["password"]):
-        st.session_state["auth_user"] = dict(row); return True
+        if needs_rehash(row["password"]):
+            run_script("UPDATE users SET password=? WHERE id=?", (hash_password(password), int(row["id"])))
+        st.session_state["auth_user"] = session_user(row); return True
     return False
 
 def ensure_admin_exists():
-    df = run_query("SELECT COUNT(*) n FROM users")
-    if int(df.loc[0,"n"]) == 0:
+    if not exists("SELECT 1 FROM users"):
         pwd = "Admin1234!"
         run_script("INSERT INTO users(username,email,password,role,created_at) VALUES(?,?,?,?,datetime('now'))",
                    ("admin","admin@example.com",hash_password(pwd),"admin"))
         st.info(f"Se creó el usuario admin / {pwd}. Cambia la contraseña.")
 
 # --------- UI ---------
-def sidebar_menu():
-    user = get_current_user()
+def sidebar_menu(user):
     if user:
         st.sidebar.markdown(f"**Conectado:** `{user['username']}` ({user['role']})")
         if st.sidebar.button("Cerrar sesión", key="btn_logout"):
-            st.session_state.pop("auth_user", None); st.rerun()
+            st.session_state.clear(); st.rerun()
     else:
         st.sidebar.info("No has iniciado sesión.")
-    return st.sidebar.selectbox("Ir a:", ["Dashboard","Tickets – Nuevo","Tickets – Bandeja","Ticket – Detalle","Activos","CMDB","Mi Perfil y Seguridad","Configuración"])
+    return st.sidebar.selectbox("Ir a:", _MENU)
 
 def page_login():
     st.title("Mesa de Ayuda + Inventarios — ITIL 4 (Enterprise+)")
-    ensure_admin_exists()
-    try_token_sso()
+    # Una vez por sesión: el login se re-ejecuta con cada cambio de widget.
+    if not st.session_state.get("_boot_done"):
+        ensure_admin_exists()
+        try_token_sso()
+        st.session_state["_boot_done"] = True
     tab_login, tab_reg, tab_reset = st.tabs(["Iniciar sesión","Registrarse","Recuperar"])
     with tab_login:
         u = st.text_input("Usuario", key="login_user")
@@ -475,6 +819,8 @@ def page_login():
         if st.button("Crear cuenta", key="btn_register"):
             if not u or not e or not p1 or p1!=p2 or len(p1)<8:
                 st.error("Completa todos los campos y usa 8+ caracteres.")
+            elif exists("SELECT 1 FROM users WHERE username=? OR email=?", (u, e)):
+                st.error("Ese usuario o email ya está registrado.")
             else:
                 run_script("INSERT INTO users(username,email,password,role,created_at) VALUES(?,?,?,?,datetime('now'))",
                            (u,e,hash_password(p1),"usuario"))
@@ -484,16 +830,18 @@ def page_login():
         if st.button("Enviar enlace", key="btn_reset_send"):
             st.info("Demo: envía un token de recuperación si SMTP está configurado.")
 
-def _ticket_code():
-    today_str = datetime.utcnow().strftime("%Y%m%d")
-    df = run_query("SELECT COUNT(*) n FROM tickets WHERE substr(created_at,1,10)=substr(datetime('now'),1,10)")
-    seq = int(df.loc[0,"n"]) + 1
+# Se llama dentro de la transacción del INSERT: el contador del día se reserva de forma atómica.
+# La primera vez de cada día parte de los tickets ya existentes (bases anteriores a ticket_seq).
+def _ticket_code(cx):
+    today = datetime.now(timezone.utc).date()
+    day = today.isoformat()
+    seq = cx.execute("""INSERT INTO ticket_seq(day,n) VALUES(?, (SELECT COUNT(*) FROM tickets WHERE created_day=?)+1)
+                        ON CONFLICT(day) DO UPDATE SET n=n+1 RETURNING n""", (day, day)).fetchone()[0]
+    today_str = today.strftime("%Y%m%d")
     return f"TCK-{today_str}-{seq:04d}"
 
-def page_tickets_nuevo():
+def page_tickets_nuevo(user):
     st.header("Nuevo ticket")
-    user = get_current_user()
-    if not user: st.warning("Inicia sesión."); return
     col1, col2 = st.columns(2)
     with col1:
         title = st.text_input("Título")
@@ -503,13 +851,12 @@ def page_tickets_nuevo():
         watchers = st.text_input("Watchers (emails separados por coma)", key="new_watchers")
         files = st.file_uploader("Adjuntos (opcional)", type=None, accept_multiple_files=True, key="new_ticket_files")
     with col2:
-        services = run_query("SELECT id, name FROM services ORDER BY name")
-        if services.empty:
+        services = q_service_options()
+        if not services:
             st.info("No hay servicios cargados. Crea algunos en Configuración → Servicios/SLAs.")
             service_id = None
         else:
-            service_name = st.selectbox("Servicio", services["name"])
-            service_id = int(services[services["name"]==service_name]["id"].iloc[0])
+            service_id = services[st.selectbox("Servicio", list(services))]
         urgency = st.selectbox("Urgencia", ["Baja","Media","Alta"])
         impact = st.selectbox("Impacto", ["Bajo","Medio","Alto"])
         priority = matrix_priority(service_id, urgency, impact) if service_id else "Media"
@@ -518,38 +865,34 @@ def page_tickets_nuevo():
     if st.button("Crear", key="btn_create_ticket", type="primary"):
         if not title or not service_id:
             st.error("Completa título y servicio."); return
-        code_t = _ticket_code()
-        now = datetime.utcnow().isoformat()
         resp_h, res_h = compute_sla(service_id, priority)
-        response_due = (datetime.utcnow() + timedelta(hours=resp_h)).isoformat()
-        resolve_due = (datetime.utcnow() + timedelta(hours=res_h)).isoformat()
-        run_script("""INSERT INTO tickets(code,title,description,category,itil_type,service_id,priority,urgency,impact,status,created_by,watchers_emails,created_at,updated_at,response_due_at,due_at)
-                      VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)""",
-                   (code_t,title.strip(),desc.strip(),category,itil_type,int(service_id),priority,urgency,impact,"Nuevo",int(user["id"]),watchers.strip(),now,now,response_due,resolve_due))
+        with transaction() as cx:
+            code_t = _ticket_code(cx)
+            tid = cx.execute(SQL_INSERT_TICKET,
+                             (code_t,title.strip(),desc.strip(),category,itil_type,int(service_id),priority,urgency,impact,"Nuevo",int(user["id"]),watchers.strip(),f"+{resp_h} hours",f"+{res_h} hours")).lastrowid
         # Adjuntos
         if files:
-            up = get_upload_root()
-            tid = int(run_query("SELECT id FROM tickets WHERE code=?", (code_t,)).loc[0,"id"])
+            folder, rows, writes = os.path.join(get_upload_root(), "ticket_attachments"), [], []
             for f in files:
                 safe = safe_filename(f.name)
-                dest = os.path.join(up, "ticket_attachments", f"{code_t}_{safe}")
-                with open(dest, "wb") as out: out.write(f.read())
-                run_script("INSERT INTO ticket_attachments(ticket_id,file_name,file_path,uploaded_by,uploaded_at) VALUES(?,?,?,?,datetime('now'))",
-                           (tid, safe, dest, int(user["id"])))
+                dest = os.path.join(folder, f"{code_t}_{safe}")
+                writes.append((f, dest))
+                rows.append((tid, safe, dest, int(user["id"])))
+            _save_uploads(writes)
+            run_many(SQL_INSERT_TICKET_ATTACHMENT, rows)
         notify_webhooks("ticket_created", {"code": code_t, "title": title, "type": itil_type, "priority": priority})
         st.success(f"Creado: {code_t}")
         st.rerun()
 
-def page_tickets_bandeja():
+def page_tickets_bandeja(user):
     st.header("Bandeja de tickets")
-    user = get_current_user()
-    if not user: st.warning("Inicia sesión."); return
+    if st.session_state.get("_last_page") != "Tickets – Bandeja":
+        st.session_state.pop("current_ticket_id", None); st.session_state.pop("current_ticket_code", None)
     t1, t2 = st.columns([3,1])
     with t1:
         tab_inc, tab_sol, tab_cam, tab_prob = st.tabs(["Incidentes","Solicitudes","Cambios","Problemas"])
     with t2:
-        teams = run_query("SELECT id, name FROM teams ORDER BY name")
-        team_filter = st.selectbox("Equipo", ["Todos"] + ([] if teams.empty else list(teams["name"])))
+        team_filter = st.selectbox("Equipo", ["Todos", *q_team_options()])
     def _grid(itil):
         base = """SELECT t.id, t.code, t.title, s.name as servicio, t.priority, t.status, u.username AS owner, t.updated_at
                   FROM tickets t
@@ -562,167 +905,206 @@ def page_tickets_bandeja():
             base += " AND t.created_by=?"; params.append(int(user["id"]))
         if team_filter and team_filter!="Todos":
             base += " AND ag.team_id=(SELECT id FROM teams WHERE name=?)"; params.append(team_filter)
-        df = run_query(base + " ORDER BY t.updated_at DESC", tuple(params))
+        df = paged_query(f"pg_bandeja_{itil}", base + " ORDER BY t.updated_at DESC", tuple(params))
+        df[["servicio","priority","status"]] = df[["servicio","priority","status"]].astype("category")
         st.dataframe(df, use_container_width=True)
         c1,c2,c3 = st.columns(3)
         tid = c1.text_input(f"ID a abrir ({itil})", "", key=f"open_{itil}")
         if c2.button("Abrir", key=f"btn_open_{itil}") and tid.strip().isdigit():
-            st.session_state["current_ticket_id"] = int(tid.strip())
-            st.rerun()
+            sql, args = "SELECT code FROM tickets WHERE id=?", [int(tid.strip())]
+            if user["role"]=="usuario":
+                sql += " AND created_by=?"; args.append(int(user["id"]))
+            code = fetchval(sql, tuple(args))
+            if code is None:
+                c3.error("No encontrado.")
+            else:
+                st.session_state["current_ticket_id"] = int(tid.strip())
+                st.session_state["current_ticket_code"] = code
+                st.rerun()
     with tab_inc: _grid("Incidente")
     with tab_sol: _grid("Solicitud")
     with tab_cam: _grid("Cambio")
     with tab_prob: _grid("Problema")
 
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as fh:
+        return fh.read()
+
+# Descarga diferida (data= callable, Streamlit >= 1.52): el archivo se lee al hacer clic, no en cada rerun.
+def download_file_button(label: str, path: str, file_name: str, key: str):
+    st.download_button(label=label, data=lambda: _read_file(path), file_name=file_name, key=key)
+
+# Qué adjuntos siguen en disco: un listdir por carpeta en vez de un intento de acceso por archivo.
+def _existing_files(paths) -> set:
+    present = set()
+    for folder in {os.path.dirname(p) for p in paths}:
+        try:
+            present.update(os.path.join(folder, name) for name in os.listdir(folder))
+        except OSError:
+            pass
+    return present
+
+# Data-URI del PDF por (ruta, mtime). No se usa static serving: expondría los adjuntos sin autenticación.
+@st.cache_resource(max_entries=16, ttl=600, show_spinner=False)
+def _pdf_data_uri(path: str, mtime: float) -> str:
+    with open(path, "rb") as fh:
+        # mmap: base64 lee directo de las páginas del archivo, sin copia intermedia en bytes
+        if os.fstat(fh.fileno()).st_size == 0:
+            return "data:application/pdf;base64,"
+        with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return "data:application/pdf;base64," + base64.b64encode(mm).decode()
+
+# La vista previa solo se envía al navegador si se pide (un expander la enviaría igual, oculta).
 def render_inline_view(file_path: str):
     try:
         ext = os.path.splitext(file_path)[1].lower()
-        if ext in [".png",".jpg",".jpeg",".gif",".webp"]:
-            with open(file_path, "rb") as fh:
-                st.image(fh.read(), caption=os.path.basename(file_path), use_container_width=True)
-        elif ext == ".pdf":
-            with open(file_path, "rb") as fh:
-                b64 = base64.b64encode(fh.read()).decode()
-            html = f'<iframe src="data:application/pdf;base64,{b64}" width="100%%" height="600px"></iframe>'
-            components.html(html, height=620, scrolling=True)
+        if ext in [".png",".jpg",".jpeg",".gif",".webp",".pdf"]:
+            if not st.toggle(f"Vista previa: {os.path.basename(file_path)}", key=f"pv_{file_path}"):
+                return
+            if ext == ".pdf":
+                src = _pdf_data_uri(file_path, os.path.getmtime(file_path))
+                components.html(f'<iframe src="{src}" width="100%%" height="600px"></iframe>', height=620, scrolling=True)
+            else:
+                st.image(file_path, caption=os.path.basename(file_path), use_container_width=True)
         else:
             st.info(f"Vista previa no soportada para: {os.path.basename(file_path)}")
     except Exception as e:
         st.warning(f"No se pudo mostrar el archivo: {e}")
 
-def page_ticket_detalle():
-    user = get_current_user()
-    if not user: st.warning("Inicia sesión."); return
+# Paneles del detalle como fragmentos: un widget dentro de uno solo re-ejecuta ese panel.
+# Los cambios que afectan al resto de la página usan st.rerun() (alcance app).
+@st.fragment
+def _status_panel(row: dict, user: dict):
+    c1,c2,c3,c4 = st.columns(4)
+    agentes = q_agents()
+    assignee = c1.selectbox("Asignar a", [] if agentes.empty else list(agentes["username"]), key="assign_user")
+    if c1.button("Asignar", key="btn_assign"):
+        if not agentes.empty:
+            ag = agentes[agentes["username"] == assignee].iloc[0]
+            uid, ag_email = int(ag["id"]), ag["email"]
+            run_script("UPDATE tickets SET assigned_to=?, updated_at=datetime('now') WHERE id=?", (uid, int(row["id"])))
+            notify_webhooks("ticket_assigned", {"code": row["code"], "assigned_to": assignee})
+            send_emails_async([(row.get('owner_email'), f"[{row['code']}] Ticket asignado", f"Tu ticket fue asignado a: {assignee}."),
+                               (ag_email, f"[{row['code']}] Se te ha asignado un ticket", f"Se te asignó el ticket {row['code']} - {row['title']}.")])
+            st.success(f"Asignado a {assignee}."); st.rerun()
+    new_status = c2.selectbox("Nuevo estado", TICKET_STATUSES, key="new_status")
+    if c2.button("Aplicar estado", key="btn_state"):
+        with transaction() as cx:
+            cx.execute(SQL_UPDATE_TICKET_STATUS, (new_status, int(row["id"])))
+            cx.execute(SQL_INSERT_STATUS_HISTORY, (int(row["id"]), new_status, int(user["id"])))
+        notify_webhooks("ticket_status", {"code": row["code"], "status": new_status})
+        # Propietario + watchers sin repetir (dict.fromkeys conserva el orden).
+        recips = dict.fromkeys(filter(None, [row.get('owner_email')] + [e.strip() for e in re.split(r"[;,]", row.get('watchers_emails') or "")]))
+        msgs = [(to, f"[{row['code']}] Estado actualizado: {new_status}", f"Tu ticket {row['code']} cambió a: {new_status}.") for to in recips]
+        if new_status=="Cerrado":
+            msgs.append((row.get('owner_email'), f"[{row['code']}] Encuesta de satisfacción", "Gracias por usar la mesa de ayuda. Por favor califica el servicio desde tu portal."))
+        send_emails_async(msgs)
+        st.success("Estado actualizado."); st.rerun()
+
+@st.fragment
+def _approvals_panel(row: dict, user: dict):
+    st.subheader("Aprobaciones")
+    flow = run_query("SELECT l.level, l.area_id FROM service_area_levels l WHERE l.service_id=? ORDER BY l.level", (int(row["service_id"]),))
+    if flow.empty:
+        st.info("No hay flujo de aprobaciones configurado para este servicio.")
+    else:
+        pending = run_query("""SELECT ca.*, a.name as area_name, u.username as approver
+                               FROM change_approvals ca
+                               JOIN areas a ON a.id=ca.area_id
+                               LEFT JOIN users u ON u.id=ca.approver_user_id
+                               WHERE ca.ticket_id=? ORDER BY ca.level""", (int(row["id"]),))
+        if pending.empty:
+            run_many("INSERT INTO change_approvals(ticket_id,service_id,area_id,level,status) VALUES(?,?,?,?,'Pendiente')",
+                     [(int(row["id"]), int(row["service_id"]), int(r.area_id), int(r.level)) for r in flow.itertuples(index=False)])
+            pending = run_query("""SELECT ca.*, a.name as area_name FROM change_approvals ca JOIN areas a ON a.id=ca.area_id WHERE ca.ticket_id=? ORDER BY ca.level""", (int(row["id"]),))
+        st.dataframe(pending[["level","area_name","status","approver_user_id","decided_at","notes"]], use_container_width=True)
+        if user["role"] in ("admin","agente"):
+            lvl = st.number_input("Nivel a decidir", min_value=1, step=1, key="appr_lvl")
+            decision = st.selectbox("Decisión", ["Aprobar","Rechazar"], key="appr_dec")
+            notes = st.text_input("Notas", key="appr_notes")
+            if st.button("Registrar decisión", key="btn_appr"):
+                new_status = "Aprobado" if decision=="Aprobar" else "Rechazado"
+                run_script("UPDATE change_approvals SET status=?, approver_user_id=?, decided_at=datetime('now'), notes=? WHERE ticket_id=? AND level=?",
+                           (new_status, int(user["id"]), notes, int(row["id"]), int(lvl)))
+                if not exists("SELECT 1 FROM change_approvals WHERE ticket_id=? AND status='Pendiente'", (int(row["id"]),)):
+                    run_script("UPDATE tickets SET status='En Progreso', updated_at=datetime('now') WHERE id=?", (int(row["id"]),))
+                    notify_webhooks("change_approved", {"code": row["code"]})
+                st.success("Decisión registrada."); st.rerun()
+
+@st.fragment
+def _attachments_panel(row: dict, user: dict):
+    st.subheader("Adjuntos")
+    at = run_query("SELECT id, file_name, file_path, uploaded_at FROM ticket_attachments WHERE ticket_id=? ORDER BY uploaded_at DESC", (int(row["id"]),))
+    if not at.empty:
+        present = _existing_files(at["file_path"])
+        for i0, r0 in at.iterrows():
+            if r0["file_path"] not in present:
+                st.write(f"No se encuentra: {r0['file_name']}"); continue
+            try:
+                download_file_button(f"Descargar: {r0['file_name']}", r0["file_path"], r0["file_name"], f"dl_att_{r0['id']}")
+                render_inline_view(r0["file_path"])
+            except Exception:
+                st.write(f"No se encuentra: {r0['file_name']}")
+    upfiles = st.file_uploader("Agregar adjuntos", accept_multiple_files=True, key="att_more")
+    # Con botón: el uploader conserva los archivos tras el rerun y sin él se volverían a insertar.
+    if upfiles and st.button("Subir adjuntos", key="btn_att_more"):
+        folder, rows, writes = os.path.join(get_upload_root(), "ticket_attachments"), [], []
+        for f in upfiles:
+            safe = safe_filename(f.name)
+            dest = os.path.join(folder, f"{row['code']}_{safe}")
+            writes.append((f, dest))
+            rows.append((int(row["id"]), safe, dest, int(user["id"])))
+        _save_uploads(writes)
+        run_many(SQL_INSERT_TICKET_ATTACHMENT, rows)
+        st.success("Adjuntos agregados."); st.rerun(scope="fragment")
+
+def page_ticket_detalle(user):
     tid = st.session_state.get("current_ticket_id")
     if not tid:
         st.info("Selecciona un ticket desde la bandeja."); return
-    t = run_query("""SELECT t.*, s.name as service_name, u.username as owner_name, u.email as owner_email,
+    row = fetchone("""SELECT t.*, s.name as service_name, u.username as owner_name, u.email as owner_email,
                             ag.username as agent_name, ag.email as agent_email
                      FROM tickets t
                      LEFT JOIN services s ON s.id=t.service_id
                      JOIN users u ON u.id=t.created_by
                      LEFT JOIN users ag ON ag.id=t.assigned_to
                      WHERE t.id=?""", (int(tid),))
-    if t.empty: st.error("No encontrado."); return
-    row = t.iloc[0]
+    if row is None: st.error("No encontrado."); return
+    row = dict(row)
     st.header(f"[{row['code']}] {row['title']}")
     st.caption(f"Propietario: {row['owner_name']} · Servicio: {row['service_name']} · Estado: {row['status']} · Prioridad: {row['priority']}")
 
     if user["role"] in ("admin","agente"):
-        c1,c2,c3,c4 = st.columns(4)
-        agentes = run_query("SELECT id, username FROM users WHERE role='agente' AND active=1 ORDER BY username")
-        assignee = c1.selectbox("Asignar a", [] if agentes.empty else list(agentes["username"]), key="assign_user")
-        if c1.button("Asignar", key="btn_assign"):
-            if not agentes.empty:
-                uid = int(agentes[agentes["username"]==assignee]["id"].iloc[0])
-                run_script("UPDATE tickets SET assigned_to=?, updated_at=datetime('now') WHERE id=?", (uid, int(tid)))
-                aginfo = run_query("SELECT email FROM users WHERE id=?", (uid,))
-                ag_email = None if aginfo.empty else aginfo.loc[0,'email']
-                notify_webhooks("ticket_assigned", {"code": row["code"], "assigned_to": assignee})
-                if row.get('owner_email'):
-                    send_email(row['owner_email'], f"[{row['code']}] Ticket asignado", f"Tu ticket fue asignado a: {assignee}.")
-                if ag_email:
-                    send_email(ag_email, f"[{row['code']}] Se te ha asignado un ticket", f"Se te asignó el ticket {row['code']} - {row['title']}.")
-                st.success(f"Asignado a {assignee}."); st.rerun()
-        new_status = c2.selectbox("Nuevo estado", ["Nuevo","Asignado","En Progreso","En Espera","Aprobación","Resuelto","Cerrado"], key="new_status")
-        if c2.button("Aplicar estado", key="btn_state"):
-            run_script("UPDATE tickets SET status=?, updated_at=datetime('now') WHERE id=?", (new_status, int(tid)))
-            run_script("INSERT INTO ticket_status_history(ticket_id,status,changed_by,changed_at) VALUES(?,?,?,datetime('now'))", (int(tid), new_status, int(user["id"])))
-            notify_webhooks("ticket_status", {"code": row["code"], "status": new_status})
-            recips = []
-            if row.get('owner_email'): recips.append(row['owner_email'])
-            if row.get('watchers_emails'):
-                for rcp in str(row['watchers_emails']).replace(';',',').split(','):
-                    rcp = rcp.strip(); 
-                    if rcp: recips.append(rcp)
-            for to in recips:
-                try:
-                    send_email(to, f"[{row['code']}] Estado actualizado: {new_status}", f"Tu ticket {row['code']} cambió a: {new_status}.")
-                except Exception:
-                    pass
-            if new_status=="Cerrado" and row.get('owner_email'):
-                send_email(row['owner_email'], f"[{row['code']}] Encuesta de satisfacción", "Gracias por usar la mesa de ayuda. Por favor califica el servicio desde tu portal.")
-            st.success("Estado actualizado."); st.rerun()
+        _status_panel(row, user)
 
     st.subheader("Descripción")
     st.write(row["description"] or "")
 
     if row["itil_type"]=="Cambio":
-        st.subheader("Aprobaciones")
-        flow = run_query("""SELECT l.level, a.name as area
-                            FROM service_area_levels l JOIN areas a ON a.id=l.area_id
-                            WHERE l.service_id=? ORDER BY l.level""", (int(row["service_id"]),))
-        if flow.empty:
-            st.info("No hay flujo de aprobaciones configurado para este servicio.")
-        else:
-            pending = run_query("""SELECT ca.*, a.name as area_name, u.username as approver
-                                   FROM change_approvals ca
-                                   JOIN areas a ON a.id=ca.area_id
-                                   LEFT JOIN users u ON u.id=ca.approver_user_id
-                                   WHERE ca.ticket_id=? ORDER BY ca.level""", (int(tid),))
-            if pending.empty:
-                for i, r in flow.iterrows():
-                    aid = int(run_query("SELECT id FROM areas WHERE name=?", (r["area"],)).loc[0,"id"])
-                    run_script("INSERT INTO change_approvals(ticket_id,service_id,area_id,level,status) VALUES(?,?,?,?,?)",
-                               (int(tid), int(row["service_id"]), aid, int(r["level"]), "Pendiente"))
-                pending = run_query("""SELECT ca.*, a.name as area_name FROM change_approvals ca JOIN areas a ON a.id=ca.area_id WHERE ca.ticket_id=? ORDER BY ca.level""", (int(tid),))
-            st.dataframe(pending[["level","area_name","status","approver_user_id","decided_at","notes"]], use_container_width=True)
-            if user["role"] in ("admin","agente"):
-                lvl = st.number_input("Nivel a decidir", min_value=1, step=1, key="appr_lvl")
-                decision = st.selectbox("Decisión", ["Aprobar","Rechazar"], key="appr_dec")
-                notes = st.text_input("Notas", key="appr_notes")
-                if st.button("Registrar decisión", key="btn_appr"):
-                    stime = datetime.utcnow().isoformat()
-                    new_status = "Aprobado" if decision=="Aprobar" else "Rechazado"
-                    run_script("UPDATE change_approvals SET status=?, approver_user_id=?, decided_at=?, notes=? WHERE ticket_id=? AND level=?",
-                               (new_status, int(user["id"]), stime, notes, int(tid), int(lvl)))
-                    rest = run_query("SELECT COUNT(*) n FROM change_approvals WHERE ticket_id=? AND status='Pendiente'", (int(tid),))
-                    if int(rest.loc[0,"n"])==0:
-                        run_script("UPDATE tickets SET status='En Progreso', updated_at=datetime('now') WHERE id=?", (int(tid),))
-                        notify_webhooks("change_approved", {"code": row["code"]})
-                    st.success("Decisión registrada."); st.rerun()
+        _approvals_panel(row, user)
 
-    st.subheader("Adjuntos")
-    at = run_query("SELECT id, file_name, file_path, uploaded_at FROM ticket_attachments WHERE ticket_id=? ORDER BY uploaded_at DESC", (int(tid),))
-    if not at.empty:
-        for i0, r0 in at.iterrows():
-            try:
-                with open(r0["file_path"], "rb") as fh:
-                    st.download_button(label=f"Descargar: {r0['file_name']}", data=fh.read(), file_name=r0["file_name"], key=f"dl_att_{r0['id']}")
-                render_inline_view(r0["file_path"])
-            except Exception:
-                st.write(f"No se encuentra: {r0['file_name']}")
-    upfiles = st.file_uploader("Agregar adjuntos", accept_multiple_files=True, key="att_more")
-    if upfiles:
-        up = get_upload_root()
-        for f in upfiles:
-            safe = safe_filename(f.name)
-            dest = os.path.join(up, "ticket_attachments", f"{row['code']}_{safe}")
-            with open(dest, "wb") as out: out.write(f.read())
-            run_script("INSERT INTO ticket_attachments(ticket_id,file_name,file_path,uploaded_by,uploaded_at) VALUES(?,?,?,?,datetime('now'))", (int(tid), safe, dest, int(user["id"])))
-        st.success("Adjuntos agregados."); st.rerun()
+    _attachments_panel(row, user)
 
     st.subheader("Historial de estados")
-    h = run_query("""SELECT h.status, h.changed_at, u.username AS by_user
+    h = paged_query("pg_hist", """SELECT h.status, h.changed_at, u.username AS by_user
                      FROM ticket_status_history h JOIN users u ON u.id=h.changed_by
-                     WHERE h.ticket_id=? ORDER BY h.changed_at DESC""", (int(tid),))
+                     WHERE h.ticket_id=? ORDER BY h.changed_at DESC""", (int(tid),), owner=int(tid))
     st.dataframe(h, use_container_width=True)
 
     st.subheader("Encuesta (propietario)")
-    if user["id"] == row["created_by"] and row["status"] in ("Resuelto","Cerrado"):
+    if user["id"] == row["created_by"] and row["status"] in TICKET_DONE:
         c1,c2,c3 = st.columns(3)
         csat = c1.slider("CSAT (1–5)", 1, 5, 5, key="csat_slider")
         ces = c2.slider("CES (1–7)", 1, 7, 3, key="ces_slider")
         nps = c3.slider("NPS (0–10)", 0, 10, 10, key="nps_slider")
         comment = st.text_input("Comentario", key="survey_comment")
         if st.button("Enviar encuesta", key="btn_survey", type="primary"):
-            now = datetime.utcnow().isoformat()
             for ttype, score in [("CSAT", int(csat)), ("CES", int(ces)), ("NPS", int(nps))]:
-                run_script("INSERT INTO ticket_surveys(ticket_id,survey_type,score,comment,created_at) VALUES(?,?,?,?,?)",
-                           (int(tid), ttype, score, comment, now))
+                run_script("INSERT INTO ticket_surveys(ticket_id,survey_type,score,comment,created_at) VALUES(?,?,?,?,datetime('now'))",
+                           (int(tid), ttype, score, comment))
             st.success("¡Gracias por tu retroalimentación!")
 
-def page_activos():
+def page_activos(user):
     st.header("Activos")
     with st.form("new_asset"):
         c1, c2, c3 = st.columns(3)
@@ -742,32 +1124,40 @@ def page_activos():
     if submitted and name.strip():
         acq_str = acq_date.isoformat() if acq_date else None
         war_str = warranty_end.isoformat() if warranty_end else None
-        ex = run_query("SELECT id FROM assets WHERE code=?", (code,))
-        if ex.empty:
-            run_script("""INSERT INTO assets(code,name,category,serial,acquisition_cost,acquisition_date,salvage_value,
-                                             fiscal_life_years, niif_life_years, warranty_end)
-                          VALUES(?,?,?,?,?,?,?,?,?,?)""",
-                       (code,name,category,serial,float(cost),acq_str,float(salvage),int(fiscal_life),int(niif_life),war_str))
-            st.success("Activo creado.")
-        else:
-            run_script("""UPDATE assets SET name=?, category=?, serial=?, acquisition_cost=?, acquisition_date=?, salvage_value=?, 
-                                         fiscal_life_years=?, niif_life_years=?, warranty_end=? WHERE code=?""",
-                       (name,category,serial,float(cost),acq_str,float(salvage),int(fiscal_life),int(niif_life),war_str,code))
-            st.success("Activo actualizado.")
-
-    a = run_query("SELECT id, code, name, category, acquisition_cost, acquisition_date, salvage_value, fiscal_life_years, niif_life_years, warranty_end FROM assets ORDER BY name")
-    st.dataframe(a, use_container_width=True)
+        run_script("""INSERT INTO assets(code,name,category,serial,acquisition_cost,acquisition_date,salvage_value,
+                                         fiscal_life_years, niif_life_years, warranty_end)
+                      VALUES(?,?,?,?,?,?,?,?,?,?)
+                      ON CONFLICT(code) DO UPDATE SET name=excluded.name, category=excluded.category, serial=excluded.serial,
+                          acquisition_cost=excluded.acquisition_cost, acquisition_date=excluded.acquisition_date,
+                          salvage_value=excluded.salvage_value, fiscal_life_years=excluded.fiscal_life_years,
+                          niif_life_years=excluded.niif_life_years, warranty_end=excluded.warranty_end""",
+                   (code,name,category,serial,float(cost),acq_str,float(salvage),int(fiscal_life),int(niif_life),war_str))
+        st.success("Activo guardado.")
+
+    # Listado paginado con las columnas de la tabla; la depreciación se calcula solo para la página visible.
+    a = paged_query("pg_assets", """SELECT id, code, name, category, acquisition_cost, acquisition_date, salvage_value,
+                                           fiscal_life_years, niif_life_years, warranty_end FROM assets ORDER BY name""")
+    st.dataframe(a.assign(libros_fiscal=compute_depreciation_df(a, "fiscal_life_years")["valor_libros"],
+                          libros_niif=compute_depreciation_df(a, "niif_life_years")["valor_libros"]), use_container_width=True)
 
     st.subheader("Detalle / Hoja de Vida / Depreciación")
-    if not a.empty:
-        sel = st.selectbox("Selecciona activo", a["code"], key="asset_sel")
-        r = run_query("SELECT * FROM assets WHERE code=?", (sel,)).iloc[0].to_dict()
+    # El selector tiene sus propias opciones (todos los activos, no solo la página); el detalle relee una fila.
+    asset_opts = cached_options("SELECT id || ' – ' || COALESCE(code,'') || ' – ' || name, id FROM assets ORDER BY name")
+    if asset_opts:
+        r = dict(fetchone("SELECT * FROM assets WHERE id=?", (asset_opts[st.selectbox("Selecciona activo", list(asset_opts), key="asset_sel")],)))
+        aid = (int(r["id"]),)
+        d = run_queries({
+            "mt2": ("SELECT id, maintenance_type, performed_at FROM asset_maintenances WHERE asset_id=? ORDER BY performed_at DESC", aid),
+            "pol": (f"SELECT id, policy_number, insurer, start_date, end_date, coverage FROM asset_policies WHERE asset_id=? ORDER BY end_date DESC LIMIT {MAX_GRID_ROWS}", aid),
+            "con": (f"SELECT id, vendor, contract_number, start_date, end_date, terms FROM asset_contracts WHERE asset_id=? ORDER BY end_date DESC LIMIT {MAX_GRID_ROWS}", aid),
+            "af": ("SELECT id, file_name, file_path, uploaded_at, file_type FROM asset_files WHERE asset_id=? AND maintenance_id IS NULL AND policy_id IS NULL AND contract_id IS NULL ORDER BY uploaded_at DESC LIMIT 200", aid),
+        })
         t1,t2,t3,t4 = st.tabs(["Detalle","Hoja de Vida","Pólizas/Contratos","Depreciación (Fiscal/NIIF)"])
         with t1:
             st.json(r)
         with t2:
             st.write("Asignaciones")
-            asg = run_query("SELECT * FROM asset_assignments WHERE asset_id=? ORDER BY assigned_at DESC", (int(r["id"]),))
+            asg = paged_query("pg_asg", "SELECT id, location, assigned_at, returned_at, notes FROM asset_assignments WHERE asset_id=? ORDER BY assigned_at DESC", aid, owner=aid[0])
             st.dataframe(asg, use_container_width=True)
             with st.form("form_asg"):
                 loc = st.text_input("Ubicación/Área", key="asg_loc")
@@ -777,7 +1167,7 @@ def page_activos():
                                (int(r["id"]), loc, notes))
                     st.success("Asignación registrada."); st.rerun()
             st.write("Mantenimientos")
-            mt = run_query("SELECT * FROM asset_maintenances WHERE asset_id=? ORDER BY performed_at DESC", (int(r["id"]),))
+            mt = paged_query("pg_mt", "SELECT id, maintenance_type, description, cost, performed_at FROM asset_maintenances WHERE asset_id=? ORDER BY performed_at DESC", aid, owner=aid[0])
             st.dataframe(mt, use_container_width=True)
             with st.form("form_maint"):
                 mtype = st.text_input("Tipo", key="mt_type")
@@ -789,37 +1179,41 @@ def page_activos():
                     st.success("Mantenimiento registrado."); st.rerun()
 
             st.markdown("#### Adjuntos por mantenimiento")
-            mt2 = run_query("SELECT id, maintenance_type, performed_at FROM asset_maintenances WHERE asset_id=? ORDER BY performed_at DESC", (int(r["id"]),))
+            mt2 = d["mt2"]
             if not mt2.empty:
-                sel_mt = st.selectbox("Selecciona mantenimiento", mt2.apply(lambda x: f"{x['id']} – {x['maintenance_type']} – {x['performed_at']}", axis=1), key="sel_mt_att")
-                sel_id = int(sel_mt.split(" – ")[0])
-                af = run_query("SELECT id, file_name, file_path, uploaded_at FROM asset_files WHERE asset_id=? AND maintenance_id=? ORDER BY uploaded_at DESC", (int(r["id"]), sel_id))
+                labels = mt2["id"].astype(str).str.cat([mt2["maintenance_type"].astype(str), mt2["performed_at"].astype(str)], sep=" – ")
+                label_to_id = dict(zip(labels, mt2["id"]))
+                sel_mt = st.selectbox("Selecciona mantenimiento", labels, key="sel_mt_att")
+                sel_id = int(label_to_id[sel_mt])
+                af = run_query("SELECT id, file_name, file_path, uploaded_at FROM asset_files WHERE asset_id=? AND maintenance_id=? ORDER BY uploaded_at DESC LIMIT 200", (int(r["id"]), sel_id))
                 if not af.empty:
+                    present = _existing_files(af["file_path"])
                     for _, r2 in af.iterrows():
+                        if r2["file_path"] not in present:
+                            st.write(f"No se encuentra: {r2['file_name']}"); continue
                         try:
-                            with open(r2["file_path"], "rb") as fh:
-                                st.download_button(label=f"Descargar: {r2['file_name']}", data=fh.read(), file_name=r2["file_name"], key=f"dl_mt_{r2['id']}")
+                            download_file_button(f"Descargar: {r2['file_name']}", r2["file_path"], r2["file_name"], f"dl_mt_{r2['id']}")
                             render_inline_view(r2["file_path"])
                         except Exception:
                             st.write(f"No se encuentra: {r2['file_name']}")
                 up_mt = st.file_uploader("Subir adjuntos de mantenimiento", accept_multiple_files=True, key="up_mt_files")
-                if up_mt:
-                    up = get_upload_root()
-                    folder = os.path.join(up, "asset_files")
-                    os.makedirs(folder, exist_ok=True)
+                if up_mt and st.button("Subir adjuntos", key="btn_up_mt"):
+                    folder = os.path.join(get_upload_root(), "asset_files")
+                    rows, writes = [], []
                     for f in up_mt:
                         safe = safe_filename(f.name)
                         dest = os.path.join(folder, f"MT{sel_id}_{safe}")
-                        with open(dest, "wb") as out: out.write(f.read())
-                        run_script("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,maintenance_id,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,?,datetime('now'))",
-                                   (int(r["id"]), safe, dest, "mantenimiento", sel_id, None))
+                        writes.append((f, dest))
+                        rows.append((int(r["id"]), safe, dest, "mantenimiento", sel_id, None))
+                    _save_uploads(writes)
+                    run_many("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,maintenance_id,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,?,datetime('now'))", rows)
                     st.success("Adjuntos agregados."); st.rerun()
             else:
                 st.info("Aún no hay mantenimientos para adjuntar archivos.")
 
         with t3:
             st.write("Pólizas")
-            pol = run_query("SELECT * FROM asset_policies WHERE asset_id=? ORDER BY end_date DESC", (int(r["id"]),))
+            pol = d["pol"]
             st.dataframe(pol, use_container_width=True)
             with st.form("form_pol"):
                 pn = st.text_input("Número póliza", key="pol_num")
@@ -833,35 +1227,39 @@ def page_activos():
                     st.success("Póliza agregada."); st.rerun()
 
             st.markdown("#### Adjuntos por póliza")
-            pol2 = run_query("SELECT id, policy_number, insurer, end_date FROM asset_policies WHERE asset_id=? ORDER BY end_date DESC", (int(r["id"]),))
-            if not pol2.empty:
-                sel_pol = st.selectbox("Selecciona póliza", pol2.apply(lambda x: f"{x['id']} – {x['policy_number']} – {x['insurer']}", axis=1), key="sel_pol_att")
-                pol_id = int(sel_pol.split(" – ")[0])
-                afp = run_query("SELECT id, file_name, file_path, uploaded_at FROM asset_files WHERE asset_id=? AND policy_id=? ORDER BY uploaded_at DESC", (int(r["id"]), pol_id))
+            # Opciones propias, sin el tope de filas de la tabla: toda póliza del activo admite adjuntos.
+            pol_opts = cached_options("SELECT id || ' – ' || COALESCE(policy_number,'') || ' – ' || COALESCE(insurer,''), id "
+                                      "FROM asset_policies WHERE asset_id=? ORDER BY end_date DESC", aid)
+            if pol_opts:
+                pol_id = int(pol_opts[st.selectbox("Selecciona póliza", list(pol_opts), key="sel_pol_att")])
+                afp = run_query("SELECT id, file_name, file_path, uploaded_at FROM asset_files WHERE asset_id=? AND policy_id=? ORDER BY uploaded_at DESC LIMIT 200", (int(r["id"]), pol_id))
                 if not afp.empty:
+                    present = _existing_files(afp["file_path"])
                     for _, r3 in afp.iterrows():
+                        if r3["file_path"] not in present:
+                            st.write(f"No se encuentra: {r3['file_name']}"); continue
                         try:
-                            with open(r3["file_path"], "rb") as fh:
-                                st.download_button(label=f"Descargar: {r3['file_name']}", data=fh.read(), file_name=r3["file_name"], key=f"dl_pol_{r3['id']}")
+                            download_file_button(f"Descargar: {r3['file_name']}", r3["file_path"], r3["file_name"], f"dl_pol_{r3['id']}")
                             render_inline_view(r3["file_path"])
                         except Exception:
                             st.write(f"No se encuentra: {r3['file_name']}")
                 up_pol = st.file_uploader("Subir adjuntos de póliza", accept_multiple_files=True, key="up_pol_files")
-                if up_pol:
-                    up = get_upload_root()
-                    folder = os.path.join(up, "asset_files"); os.makedirs(folder, exist_ok=True)
+                if up_pol and st.button("Subir adjuntos", key="btn_up_pol"):
+                    folder = os.path.join(get_upload_root(), "asset_files")
+                    rows, writes = [], []
                     for f in up_pol:
                         safe = safe_filename(f.name)
                         dest = os.path.join(folder, f"POL{pol_id}_{safe}")
-                        with open(dest, "wb") as out: out.write(f.read())
-                        run_script("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,policy_id,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,?,datetime('now'))",
-                                   (int(r["id"]), safe, dest, "poliza", pol_id, None))
+                        writes.append((f, dest))
+                        rows.append((int(r["id"]), safe, dest, "poliza", pol_id, None))
+                    _save_uploads(writes)
+                    run_many("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,policy_id,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,?,datetime('now'))", rows)
                     st.success("Adjuntos agregados."); st.rerun()
             else:
                 st.info("Aún no hay pólizas para adjuntar archivos.")
 
             st.write("Contratos")
-            con = run_query("SELECT * FROM asset_contracts WHERE asset_id=? ORDER BY end_date DESC", (int(r["id"]),))
+            con = d["con"]
             st.dataframe(con, use_container_width=True)
             with st.form("form_con"):
                 ven = st.text_input("Proveedor", key="con_vendor")
@@ -875,76 +1273,86 @@ def page_activos():
                     st.success("Contrato agregado."); st.rerun()
 
             st.markdown("#### Adjuntos por contrato")
-            con2 = run_query("SELECT id, contract_number, vendor, end_date FROM asset_contracts WHERE asset_id=? ORDER BY end_date DESC", (int(r["id"]),))
-            if not con2.empty:
-                sel_con = st.selectbox("Selecciona contrato", con2.apply(lambda x: f"{x['id']} – {x['contract_number']} – {x['vendor']}", axis=1), key="sel_con_att")
-                con_id = int(sel_con.split(" – ")[0])
-                afc = run_query("SELECT id, file_name, file_path, uploaded_at FROM asset_files WHERE asset_id=? AND contract_id=? ORDER BY uploaded_at DESC", (int(r["id"]), con_id))
+            con_opts = cached_options("SELECT id || ' – ' || COALESCE(contract_number,'') || ' – ' || COALESCE(vendor,''), id "
+                                      "FROM asset_contracts WHERE asset_id=? ORDER BY end_date DESC", aid)
+            if con_opts:
+                con_id = int(con_opts[st.selectbox("Selecciona contrato", list(con_opts), key="sel_con_att")])
+                afc = run_query("SELECT id, file_name, file_path, uploaded_at FROM asset_files WHERE asset_id=? AND contract_id=? ORDER BY uploaded_at DESC LIMIT 200", (int(r["id"]), con_id))
                 if not afc.empty:
+                    present = _existing_files(afc["file_path"])
                     for _, r4 in afc.iterrows():
+                        if r4["file_path"] not in present:
+                            st.write(f"No se encuentra: {r4['file_name']}"); continue
                         try:
-                            with open(r4["file_path"], "rb") as fh:
-                                st.download_button(label=f"Descargar: {r4['file_name']}", data=fh.read(), file_name=r4["file_name"], key=f"dl_con_{r4['id']}")
+                            download_file_button(f"Descargar: {r4['file_name']}", r4["file_path"], r4["file_name"], f"dl_con_{r4['id']}")
                             render_inline_view(r4["file_path"])
                         except Exception:
                             st.write(f"No se encuentra: {r4['file_name']}")
                 up_con = st.file_uploader("Subir adjuntos de contrato", accept_multiple_files=True, key="up_con_files")
-                if up_con:
-                    up = get_upload_root()
-                    folder = os.path.join(up, "asset_files"); os.makedirs(folder, exist_ok=True)
+                if up_con and st.button("Subir adjuntos", key="btn_up_con"):
+                    folder = os.path.join(get_upload_root(), "asset_files")
+                    rows, writes = [], []
                     for f in up_con:
                         safe = safe_filename(f.name)
                         dest = os.path.join(folder, f"CON{con_id}_{safe}")
-                        with open(dest, "wb") as out: out.write(f.read())
-                        run_script("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,contract_id,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,?,datetime('now'))",
-                                   (int(r["id"]), safe, dest, "contrato", con_id, None))
+                        writes.append((f, dest))
+                        rows.append((int(r["id"]), safe, dest, "contrato", con_id, None))
+                    _save_uploads(writes)
+                    run_many("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,contract_id,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,?,datetime('now'))", rows)
                     st.success("Adjuntos agregados."); st.rerun()
             else:
                 st.info("Aún no hay contratos para adjuntar archivos.")
 
         with t4:
             st.subheader("Adjuntos del activo (generales)")
-            af = run_query("SELECT id, file_name, file_path, uploaded_at, file_type FROM asset_files WHERE asset_id=? AND maintenance_id IS NULL AND policy_id IS NULL AND contract_id IS NULL ORDER BY uploaded_at DESC", (int(r["id"]),))
+            af = d["af"]
             if not af.empty:
+                present = _existing_files(af["file_path"])
                 for _, r0 in af.iterrows():
+                    if r0["file_path"] not in present:
+                        st.write(f"No se encuentra: {r0['file_name']}"); continue
                     try:
-                        with open(r0["file_path"], "rb") as fh:
-                            st.download_button(label=f"Descargar: {r0['file_name']} ({r0.get('file_type','')})", data=fh.read(), file_name=r0["file_name"], key=f"dl_af_{r0['id']}")
+                        download_file_button(f"Descargar: {r0['file_name']} ({r0.get('file_type','')})", r0["file_path"], r0["file_name"], f"dl_af_{r0['id']}")
                         render_inline_view(r0["file_path"])
                     except Exception:
                         st.write(f"No se encuentra: {r0['file_name']}")
             new_af = st.file_uploader("Subir adjuntos generales", accept_multiple_files=True, key="af_upload")
             af_type = st.text_input("Tipo (general, factura, garantia, foto, etc.)", key="af_type")
-            if new_af:
-                up = get_upload_root()
-                folder = os.path.join(up, "asset_files"); os.makedirs(folder, exist_ok=True)
+            if new_af and st.button("Subir adjuntos", key="btn_af_upload"):
+                folder = os.path.join(get_upload_root(), "asset_files")
+                rows, writes = [], []
                 for f in new_af:
                     safe = safe_filename(f.name)
                     dest = os.path.join(folder, f"{r['code']}_{safe}")
-                    with open(dest, "wb") as out: out.write(f.read())
-                    run_script("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,datetime('now'))", (int(r["id"]), safe, dest, af_type or "general", None))
+                    writes.append((f, dest))
+                    rows.append((int(r["id"]), safe, dest, af_type or "general", None))
+                _save_uploads(writes)
+                run_many("INSERT INTO asset_files(asset_id,file_name,file_path,file_type,uploaded_by,uploaded_at) VALUES(?,?,?,?,?,datetime('now'))", rows)
                 st.success("Adjuntos agregados."); st.rerun()
 
-            (pm_f, acc_f, vl_f, m_f), (pm_n, acc_n, vl_n, m_n) = compute_depr_pair(r)
+            pm_f, acc_f, vl_f, m_f = compute_depreciation(r["acquisition_cost"], r["salvage_value"], r["fiscal_life_years"], r["acquisition_date"])
+            pm_n, acc_n, vl_n, m_n = compute_depreciation(r["acquisition_cost"], r["salvage_value"], r["niif_life_years"], r["acquisition_date"])
             c1,c2,c3,c4 = st.columns(4)
             c1.metric("Mensual Fiscal", pm_f); c2.metric("Acum. Fiscal", acc_f); c3.metric("Libros Fiscal", vl_f); c4.metric("Meses Fisc.", m_f)
             c1,c2,c3,c4 = st.columns(4)
             c1.metric("Mensual NIIF", pm_n); c2.metric("Acum. NIIF", acc_n); c3.metric("Libros NIIF", vl_n); c4.metric("Meses NIIF", m_n)
             if st.button("Exportar XLSX", key="btn_xlsx", type="primary"):
-                df_pol = run_query("SELECT * FROM asset_policies WHERE asset_id=?", (int(r["id"]),))
-                df_con = run_query("SELECT * FROM asset_contracts WHERE asset_id=?", (int(r["id"]),))
-                df_asg = run_query("SELECT * FROM asset_assignments WHERE asset_id=?", (int(r["id"]),))
-                df_mt = run_query("SELECT * FROM asset_maintenances WHERE asset_id=?", (int(r["id"]),))
+                # La exportación lleva las tablas completas; en pantalla van paginadas o con tope.
+                x = run_queries({"pol": ("SELECT id, policy_number, insurer, start_date, end_date, coverage FROM asset_policies WHERE asset_id=? ORDER BY end_date DESC", aid),
+                                 "con": ("SELECT id, vendor, contract_number, start_date, end_date, terms FROM asset_contracts WHERE asset_id=? ORDER BY end_date DESC", aid),
+                                 "asg": ("SELECT id, user_id, location, assigned_at, returned_at, notes FROM asset_assignments WHERE asset_id=? ORDER BY assigned_at DESC", aid),
+                                 "mt": ("SELECT id, maintenance_type, description, cost, performed_by, performed_at, notes FROM asset_maintenances WHERE asset_id=? ORDER BY performed_at DESC", aid)})
                 bio = io.BytesIO()
-                with pd.ExcelWriter(bio, engine="openpyxl") as writer:
+                with pd.ExcelWriter(bio, engine="xlsxwriter") as writer:
                     pd.DataFrame([r]).to_excel(writer, index=False, sheet_name="Activo")
-                    df_pol.to_excel(writer, index=False, sheet_name="Polizas")
-                    df_con.to_excel(writer, index=False, sheet_name="Contratos")
-                    df_asg.to_excel(writer, index=False, sheet_name="Asignaciones")
-                    df_mt.to_excel(writer, index=False, sheet_name="Mantenimientos")
+                    x["pol"].to_excel(writer, index=False, sheet_name="Polizas")
+                    x["con"].to_excel(writer, index=False, sheet_name="Contratos")
+                    x["asg"].to_excel(writer, index=False, sheet_name="Asignaciones")
+                    x["mt"].to_excel(writer, index=False, sheet_name="Mantenimientos")
+                # getvalue() es la única copia: st.download_button guarda bytes en su almacén de medios.
                 st.download_button("Descargar XLSX", data=bio.getvalue(), file_name=f"activo_{r['code']}.xlsx", mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
 
-def page_cmdb():
+def page_cmdb(user):
     st.header("CMDB")
     with st.form("ci_form"):
         name = st.text_input("Nombre CI", key="ci_name")
@@ -952,36 +1360,37 @@ def page_cmdb():
         if st.form_submit_button("Crear CI", use_container_width=True):
             run_script("INSERT INTO ci_items(name,ci_type) VALUES(?,?)", (name,ci_type))
             st.success("CI creado."); st.rerun()
-    cis = run_query("SELECT * FROM ci_items ORDER BY name")
+    cis = paged_query("pg_cis", "SELECT id, name, ci_type FROM ci_items ORDER BY name")
     st.dataframe(cis, use_container_width=True)
 
     st.subheader("Relaciones CI")
-    cis2 = run_query("SELECT id, name FROM ci_items ORDER BY name")
+    cis2 = q_ci_items()
+    name_to_id = dict(zip(cis2['name'].tolist(), cis2['id'].tolist()))
     if not cis2.empty:
         with st.form("ci_rel_form"):
             p = st.selectbox("CI Padre", cis2['name'], key="rel_parent")
             c = st.selectbox("CI Hijo", cis2['name'], key="rel_child")
             r = st.text_input("Tipo de relación", key="rel_type")
             if st.form_submit_button("Crear relación", use_container_width=True):
-                pid = int(cis2.loc[cis2['name']==p,'id'].iloc[0])
-                cid = int(cis2.loc[cis2['name']==c,'id'].iloc[0])
+                pid = int(name_to_id[p]); cid = int(name_to_id[c])
                 if pid == cid:
                     st.error("Padre y Hijo no pueden ser el mismo.")
                 else:
-                    run_script("INSERT INTO ci_relations(parent_ci_id,child_ci_id,relation_type) VALUES(?,?,?)", (pid,cid,r.strip()))
-                    st.success("Relación creada."); st.rerun()
-    rel = run_query("""SELECT pr.name AS padre, ch.name AS hijo, r.relation_type
+                    with transaction() as cx:
+                        added = cx.execute("INSERT OR IGNORE INTO ci_relations(parent_ci_id,child_ci_id,relation_type) VALUES(?,?,?)", (pid,cid,r.strip())).rowcount
+                    if added:
+                        st.success("Relación creada."); st.rerun()
+                    else:
+                        st.info("La relación ya existe.")
+    rel = paged_query("pg_cirel", """SELECT pr.name AS padre, ch.name AS hijo, r.relation_type
                        FROM ci_relations r
                        JOIN ci_items pr ON pr.id=r.parent_ci_id
                        JOIN ci_items ch ON ch.id=r.child_ci_id
                        ORDER BY pr.name, ch.name""")
     st.dataframe(rel, use_container_width=True)
 
-def page_mi_perfil_seguridad():
+def page_mi_perfil_seguridad(user):
     st.header("Mi Perfil y Seguridad")
-    user = get_current_user()
-    if user is None:
-        st.warning("Inicia sesión para gestionar tu perfil."); return
 
     st.subheader("Cambiar contraseña")
     with st.form("form_change_pwd"):
@@ -990,9 +1399,9 @@ def page_mi_perfil_seguridad():
         new2 = st.text_input("Confirmar nueva contraseña", type="password", key="chg_pwd_new2")
         submitted = st.form_submit_button("Actualizar contraseña", use_container_width=True)
     if submitted:
-        u = run_query("SELECT id, password FROM users WHERE id=?", (user['id'],))
-        if u.empty: st.error("Usuario no encontrado.")
-        elif not verify_password(old, u.loc[0,'password']): st.error("La contraseña actual no es correcta.")
+        u = fetchone("SELECT id, password FROM users WHERE id=?", (user['id'],))
+        if u is None: st.error("Usuario no encontrado.")
+        elif not verify_password(old, u['password']): st.error("La contraseña actual no es correcta.")
         elif len(new1) < 8 or new1 != new2: st.error("La nueva contraseña debe tener al menos 8 caracteres y coincidir.")
         else:
             run_script("UPDATE users SET password=? WHERE id=?", (hash_password(new1), user['id']))
@@ -1008,25 +1417,31 @@ def page_mi_perfil_seguridad():
     if submitted_e:
         if not new_email: st.error("Ingresa el nuevo correo.")
         else:
-            u = run_query("SELECT id, password, email FROM users WHERE id=?", (user['id'],))
-            if u.empty: st.error("Usuario no encontrado.")
-            elif not verify_password(confirm_pwd, u.loc[0,'password']): st.error("La contraseña no es correcta.")
-            elif int(run_query("SELECT COUNT(*) n FROM users WHERE email=? AND id<>?", (new_email, int(user['id']))).loc[0,'n'])>0:
+            u = fetchone("SELECT id, password, email FROM users WHERE id=?", (user['id'],))
+            if u is None: st.error("Usuario no encontrado.")
+            elif not verify_password(confirm_pwd, u['password']): st.error("La contraseña no es correcta.")
+            elif exists("SELECT 1 FROM users WHERE email=? AND id<>?", (new_email, int(user['id']))):
                 st.error("Ese correo ya está en uso por otro usuario.")
             else:
                 run_script("UPDATE users SET email=? WHERE id=?", (new_email, user['id']))
                 st.success("Correo actualizado.")
-                df = run_query("SELECT * FROM users WHERE id=?", (user['id'],))
-                st.session_state["auth_user"] = dict(df.iloc[0])
+                st.session_state["auth_user"] = session_user(fetchone("SELECT * FROM users WHERE id=?", (user['id'],)))
+
+# Sondea el envío de prueba sin bloquear la página; al terminar, un rerun completo muestra el resultado.
+@st.fragment(run_every=0.5)
+def _smtp_test_wait(to: str):
+    pending = st.session_state.get("_smtp_test")
+    if pending is None or pending[1].done():
+        st.rerun()
+    st.info(f"Enviando prueba a {to}…")
 
-def page_configuracion():
+def page_configuracion(user):
     st.header("Configuración")
-    user = get_current_user()
-    if user is None or user["role"]!="admin":
+    if user["role"]!="admin":
         st.info("Solo administradores pueden modificar configuración."); return
     tabs = st.tabs(["Usuarios/Roles","Servicios/SLAs","Matriz U×I","Aprobaciones","Notificaciones/SSO"])
     with tabs[0]:
-        u = run_query("SELECT id, username, email, role, team_id, active FROM users ORDER BY id")
+        u = paged_query("pg_cfg_users", "SELECT id, username, email, role, team_id, active FROM users ORDER BY id")
         st.dataframe(u, use_container_width=True)
         st.markdown("### Crear usuario")
         with st.form("create_user"):
@@ -1035,15 +1450,18 @@ def page_configuracion():
             rx = st.selectbox("Rol", ["admin","agente","usuario"], key="cfg_role")
             px = st.text_input("Contraseña", type="password", key="cfg_pwd")
             if st.form_submit_button("Crear", use_container_width=True):
-                run_script("INSERT INTO users(username,email,password,role,created_at) VALUES(?,?,?,?,datetime('now'))",
-                           (ux,ex,hash_password(px),rx))
-                st.success("Usuario creado."); st.rerun()
+                if exists("SELECT 1 FROM users WHERE username=? OR email=?", (ux, ex)):
+                    st.error("Ese usuario o email ya está registrado.")
+                else:
+                    run_script("INSERT INTO users(username,email,password,role,created_at) VALUES(?,?,?,?,datetime('now'))",
+                               (ux,ex,hash_password(px),rx))
+                    st.success("Usuario creado."); st.rerun()
         st.markdown("### Equipos")
         tname = st.text_input("Nuevo equipo", key="cfg_team")
         if st.button("Crear equipo", key="btn_team_create"):
             run_script("INSERT INTO teams(name) VALUES(?)", (tname,)); st.success("Equipo creado."); st.rerun()
         st.markdown("### Editar usuario")
-        u2 = run_query("SELECT id, username, email, role, active FROM users ORDER BY username")
+        u2 = cached_query("SELECT id, username, COALESCE(email,'') AS email, role, active FROM users ORDER BY username")
         if not u2.empty:
             sel_u = st.selectbox("Usuario", u2["username"], key="cfg_edit_user_sel")
             row = u2[u2["username"]==sel_u].iloc[0]
@@ -1054,7 +1472,7 @@ def page_configuracion():
                 new_pwd = st.text_input("Resetear contraseña (opcional)", type="password", key="cfg_edit_user_pwd")
                 ok = st.form_submit_button("Guardar cambios", use_container_width=True)
             if ok:
-                if new_email and int(run_query("SELECT COUNT(*) n FROM users WHERE email=? AND id <> ?", (new_email, int(row["id"]))).loc[0,"n"]) > 0:
+                if new_email and exists("SELECT 1 FROM users WHERE email=? AND id<>?", (new_email, int(row["id"]))):
                     st.error("Ese email ya está en uso.")
                 else:
                     if new_pwd:
@@ -1067,7 +1485,8 @@ def page_configuracion():
 
     with tabs[1]:
         st.markdown("### Servicios")
-        s = run_query("SELECT id, name FROM services ORDER BY name")
+        s = q_services()
+        svc_id = dict(zip(s["name"], s["id"]))
         st.dataframe(s, use_container_width=True)
         new_s = st.text_input("Nuevo servicio", key="svc_new")
         if st.button("Crear servicio", key="btn_svc_create"): 
@@ -1076,8 +1495,8 @@ def page_configuracion():
         st.markdown("### SLAs por Prioridad")
         if not s.empty:
             svc = st.selectbox("Servicio", s["name"], key="sla_svc")
-            sid = int(s[s["name"]==svc]["id"].iloc[0])
-            df = run_query("SELECT priority, response_hours, resolve_hours FROM service_sla WHERE service_id=?", (sid,))
+            sid = int(svc_id[svc])
+            df = q_service_sla(sid)
             st.dataframe(df, use_container_width=True)
             c1,c2,c3 = st.columns(3)
             with st.form("form_sla"):
@@ -1085,38 +1504,33 @@ def page_configuracion():
                 rh = c2.number_input("Horas respuesta", min_value=1, step=1, key="sla_rh")
                 oh = c3.number_input("Horas resolución", min_value=1, step=1, key="sla_oh")
                 if st.form_submit_button("Guardar SLA", use_container_width=True):
-                    ex = run_query("SELECT COUNT(*) n FROM service_sla WHERE service_id=? AND priority=?", (sid, pr))
-                    if int(ex.loc[0,"n"])>0:
-                        run_script("UPDATE service_sla SET response_hours=?, resolve_hours=? WHERE service_id=? AND priority=?", (int(rh), int(oh), sid, pr))
-                    else:
-                        run_script("INSERT INTO service_sla(service_id,priority,response_hours,resolve_hours) VALUES(?,?,?,?)", (sid, pr, int(rh), int(oh)))
+                    run_script("""INSERT INTO service_sla(service_id,priority,response_hours,resolve_hours) VALUES(?,?,?,?)
+                                  ON CONFLICT(service_id, priority) DO UPDATE SET response_hours=excluded.response_hours, resolve_hours=excluded.resolve_hours""",
+                               (sid, pr, int(rh), int(oh)))
                     st.success("SLA guardado."); st.rerun()
 
     with tabs[2]:
         st.markdown("### Matriz Urgencia × Impacto por servicio")
-        s = run_query("SELECT id, name FROM services ORDER BY name")
         if s.empty: st.info("Crea servicios primero.")
         else:
             svc = st.selectbox("Servicio", s["name"], key="mx_svc")
-            sid = int(s[s["name"]==svc]["id"].iloc[0])
-            df = run_query("SELECT urgency, impact, priority FROM service_matrix WHERE service_id=? ORDER BY urgency, impact", (sid,))
+            sid = int(svc_id[svc])
+            df = q_service_matrix(sid)
             st.dataframe(df, use_container_width=True)
             with st.form("form_mx"):
                 u = st.selectbox("Urgencia", ["Baja","Media","Alta"], key="mx_u")
                 i = st.selectbox("Impacto", ["Bajo","Medio","Alto"], key="mx_i")
                 p = st.selectbox("Prioridad", ["Baja","Media","Alta","Crítica"], key="mx_p")
                 if st.form_submit_button("Guardar regla", use_container_width=True):
-                    ex = run_query("SELECT COUNT(*) n FROM service_matrix WHERE service_id=? AND urgency=? AND impact=?", (sid, u, i))
-                    if int(ex.loc[0,"n"])>0:
-                        run_script("UPDATE service_matrix SET priority=? WHERE service_id=? AND urgency=? AND impact=?", (p, sid, u, i))
-                    else:
-                        run_script("INSERT INTO service_matrix(service_id,urgency,impact,priority) VALUES(?,?,?,?)", (sid, u, i, p))
+                    run_script("""INSERT INTO service_matrix(service_id,urgency,impact,priority) VALUES(?,?,?,?)
+                                  ON CONFLICT(service_id, urgency, impact) DO UPDATE SET priority=excluded.priority""",
+                               (sid, u, i, p))
                     st.success("Matriz guardada."); st.rerun()
 
     with tabs[3]:
         st.markdown("### Aprobaciones por Servicio/Área (workflow para Cambios)")
-        s = run_query("SELECT id, name FROM services ORDER BY name")
-        a = run_query("SELECT id, name FROM areas ORDER BY name")
+        a = q_areas()
+        area_id = dict(zip(a["name"], a["id"]))
         st.dataframe(a, use_container_width=True)
         with st.form("form_area"):
             an = st.text_input("Nueva área", key="area_new")
@@ -1125,66 +1539,108 @@ def page_configuracion():
         if s.empty or a.empty: st.info("Crea servicios y áreas antes de definir niveles.")
         else:
             svc = st.selectbox("Servicio", s["name"], key="appr_svc")
-            sid = int(s[s["name"]==svc]["id"].iloc[0])
+            sid = int(svc_id[svc])
             area = st.selectbox("Área", a["name"], key="appr_area")
-            aid = int(a[a["name"]==area]["id"].iloc[0])
+            aid = int(area_id[area])
             level = st.number_input("Nivel", min_value=1, step=1, key="appr_level")
             if st.button("Agregar nivel", key="btn_add_level"):
                 run_script("INSERT OR IGNORE INTO service_area_levels(service_id,area_id,level) VALUES(?,?,?)", (sid, aid, int(level)))
                 st.success("Nivel agregado."); st.rerun()
-            flow = run_query("""SELECT l.level, ar.name as area FROM service_area_levels l JOIN areas ar ON ar.id=l.area_id
+            flow = cached_query("""SELECT l.level, ar.name as area FROM service_area_levels l JOIN areas ar ON ar.id=l.area_id
                                 WHERE l.service_id=? ORDER BY l.level""", (sid,))
             st.dataframe(flow, use_container_width=True)
 
     with tabs[4]:
         st.markdown("### Notificaciones y SSO")
         st.subheader("SMTP (persistente en DB)")
-        with st.form("smtp_cfg_form"):
-            host = st.text_input("SMTP Host", value=get_setting("smtp_host",""), key="smtp_host")
-            port = st.number_input("SMTP Port", min_value=1, max_value=65535, value=int(get_setting("smtp_port","587") or 587), key="smtp_port")
-            userv = st.text_input("SMTP User", value=get_setting("smtp_user",""), key="smtp_user")
-            pwdv  = st.text_input("SMTP Password", value=get_setting("smtp_password",""), type="password", key="smtp_pwd")
-            fromv = st.text_input("From (opcional)", value=get_setting("smtp_from",""), key="smtp_from")
+        # Valores iniciales del formulario: una lectura por sesión, se renuevan al guardar.
+        if "_smtp_defaults" not in st.session_state:
+            st.session_state["_smtp_defaults"] = get_settings_bulk(SMTP_KEYS)
+        cur = st.session_state["_smtp_defaults"]
+        default_port = int(cur.get("smtp_port") or 587)
+        with st.form("smtp_cfg_form", border=False):
+            host = st.text_input("SMTP Host", value=cur.get("smtp_host",""), key="smtp_host")
+            port = st.number_input("SMTP Port", min_value=1, max_value=65535, value=default_port, key="smtp_port")
+            userv = st.text_input("SMTP User", value=cur.get("smtp_user",""), key="smtp_user")
+            pwdv  = st.text_input("SMTP Password", value=cur.get("smtp_password",""), type="password", key="smtp_pwd")
+            fromv = st.text_input("From (opcional)", value=cur.get("smtp_from",""), key="smtp_from")
             ok = st.form_submit_button("Guardar SMTP", use_container_width=True)
         if ok:
-            set_setting("smtp_host", host.strip())
-            set_setting("smtp_port", str(int(port)))
-            set_setting("smtp_user", userv.strip())
-            set_setting("smtp_password", pwdv.strip())
-            set_setting("smtp_from", fromv.strip())
+            new = {"smtp_host": host.strip(), "smtp_port": str(port), "smtp_user": userv.strip(),
+                   "smtp_password": pwdv.strip(), "smtp_from": fromv.strip()}
+            # Solo las claves que cambiaron; guardar sin ediciones no escribe nada.
+            for k, v in new.items():
+                if cur.get(k) != v: set_setting(k, v)
+            st.session_state.pop("_smtp_defaults", None)
             st.success("SMTP guardado.")
         st.markdown("---")
         st.subheader("Probar envío")
-        test_to = st.text_input("Enviar correo de prueba a:", key="smtp_test_to")
-        if st.button("Enviar prueba", key="btn_smtp_test", type="primary"):
-            if send_email(test_to, "Prueba SMTP", "Este es un correo de prueba de la Mesa de Ayuda."):
-                st.success("¡Enviado! Revisa tu bandeja.")
-            else:
-                st.error("No se pudo enviar. Verifica la configuración.")
+        # La prueba solo tiene sentido con SMTP configurado (DB o variables de entorno).
+        if _smtp_config() is None:
+            st.caption("Guarda la configuración SMTP para poder enviar una prueba.")
+        else:
+            test_to = st.text_input("Enviar correo de prueba a:", key="smtp_test_to")
+            if st.button("Enviar prueba", key="btn_smtp_test", type="primary"):
+                to = test_to.strip()
+                # Sin destinatario válido no se abre la conexión SMTP.
+                if not _EMAIL_RE.fullmatch(to):
+                    st.warning("Ingresa un correo de destino válido.")
+                elif (fut := send_email(to, "Prueba SMTP", "Este es un correo de prueba de la Mesa de Ayuda.")) is None:
+                    st.error("No se pudo enviar. Verifica la configuración.")
+                else:
+                    st.session_state["_smtp_test"] = (to, fut)
+            # El envío corre en el pool de correo; el resultado se muestra cuando el Future termina.
+            pending = st.session_state.get("_smtp_test")
+            if pending and pending[1].done():
+                del st.session_state["_smtp_test"]
+                if pending[1].result():
+                    st.success("¡Enviado! Revisa tu bandeja.")
+                else:
+                    st.error("No se pudo enviar. Verifica la configuración.")
+            elif pending:
+                _smtp_test_wait(pending[0])
         st.markdown("---")
-        st.write("- **SSO Token**: usa `SSO_SHARED_SECRET` y URL con `?user=<u>&ts=<unix>&sig=<hmac>`")
-        st.write("- **Webhooks**: define SLACK_WEBHOOK_URL / TEAMS_WEBHOOK_URL / DISCORD_WEBHOOK_URL (variables de entorno)")
-
+        st.markdown("- **SSO Token**: usa `SSO_SHARED_SECRET` y URL con `?user=<u>&ts=<unix>&sig=<hmac>`\n"
+                    "- **Webhooks**: define SLACK_WEBHOOK_URL / TEAMS_WEBHOOK_URL / DISCORD_WEBHOOK_URL (variables de entorno)")
+
+def page_dashboard(user):
+    st.header("Dashboard")
+    m = analytics_query(SQL_DASHBOARD_METRICS, dashboard_params(user["id"])).iloc[0]
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Tickets", int(m["total"])); c2.metric("Abiertos", int(m["abiertos"])); c3.metric("SLA vencido", int(m["vencidos"]))
+    c1, c2, c3 = st.columns(3)
+    c1.metric("Mis abiertos", int(m["mis_abiertos"])); c2.metric("Vencen en 24 h", int(m["mis_24h"])); c3.metric("Mis vencidos", int(m["mis_vencidos"]))
+    t = pd.DataFrame({"status": TICKET_STATUSES, "n": m.iloc[_METRIC_COLS:].tolist()})
+    st.dataframe(t, use_container_width=True)
+
+# Página del menú -> función que la dibuja; todas reciben el usuario en sesión.
+PAGES: dict[str, Callable[[dict], None]] = {
+    "Dashboard": page_dashboard,
+    "Tickets – Nuevo": page_tickets_nuevo,
+    "Tickets – Bandeja": page_tickets_bandeja,
+    "Ticket – Detalle": page_ticket_detalle,
+    "Activos": page_activos,
+    "CMDB": page_cmdb,
+    "Mi Perfil y Seguridad": page_mi_perfil_seguridad,
+    "Configuración": page_configuracion,
+}
+_MENU = tuple(PAGES)  # opciones del menú lateral, en el mismo orden que PAGES
+
+# El usuario se resuelve una vez por rerun y se pasa a la página; las páginas no lo releen.
 def router():
     user = get_current_user()
     if not user:
         page_login(); return
-    page = sidebar_menu()
-    if page == "Dashboard":
-        st.header("Dashboard")
-        t = run_query("SELECT status, COUNT(*) n FROM tickets GROUP BY status ORDER BY 2 DESC")
-        st.dataframe(t, use_container_width=True)
-    elif page == "Tickets – Nuevo": page_tickets_nuevo()
-    elif page == "Tickets – Bandeja": page_tickets_bandeja()
-    elif page == "Ticket – Detalle": page_ticket_detalle()
-    elif page == "Activos": page_activos()
-    elif page == "CMDB": page_cmdb()
-    elif page == "Mi Perfil y Seguridad": page_mi_perfil_seguridad()
-    elif page == "Configuración": page_configuracion()
-    else: st.stop()
+    page = sidebar_menu(user)
+    handler = PAGES.get(page)
+    if handler is None: st.stop()
+    try:
+        handler(user)
+    finally:
+        st.session_state["_last_page"] = page
 
 def main():
-    st.set_page_config(page_title="Mesa de Ayuda + Inventarios (Enterprise+)", layout="wide")
+    _inject_css()
     router()
 
 if __name__ == "__main__":